@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from metrics import Counter
+from rate_limiter import TokenBucket
+from config import (
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_USER_RATE,
+    ADMISSION_USER_BURST,
+    ADMISSION_NOTIFY_INTERVAL,
+)
+
+# Lower values are admitted first
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+
+# Reasons an update is shed
+SHED_RATE_LIMITED = 'rate_limited'
+SHED_QUEUE_FULL = 'queue_full'
+SHED_TIMEOUT = 'timeout'
+
+# Per-user buckets kept before the least recently used are dropped
+MAX_TRACKED_USERS = 10000
+
+ADMISSIONS = Counter('bot_admission_total', 'Updates admitted or shed by admission control', ('kind', 'outcome'))
+
+def _kind(priority: int) -> str:
+    return 'callback' if priority == PRIORITY_CALLBACK else 'message'
+
+class AdmissionController:
+    """
+    Gate in front of handler execution.
+
+    At most ``max_in_flight`` updates run at once. Up to ``max_queue`` more
+    wait for a slot, button callbacks ahead of messages; when the queue is
+    full a callback displaces the newest waiting message. An update still
+    waiting at its deadline (``max_wait`` after arrival) is shed, and so is
+    one beyond its user's ``user_rate`` turns per second (``user_burst``
+    burst). Shed updates get a cheap reply instead of a Voiceflow call.
+
+    ``max_queue=None``, ``user_rate=0`` and ``max_wait=0`` each disable
+    that limit.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: Optional[int] = ADMISSION_MAX_QUEUE,
+                 user_rate: float = ADMISSION_USER_RATE, user_burst: float = ADMISSION_USER_BURST,
+                 max_wait: float = ADMISSION_MAX_WAIT, notify_interval: float = ADMISSION_NOTIFY_INTERVAL):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be a positive integer")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.notify_interval = notify_interval
+        self._in_flight = 0
+        self._waiters: List[tuple] = []
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._users: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._notified: "OrderedDict[str, float]" = OrderedDict()
+        self.accepted = 0
+        self.shed: Dict[str, int] = {SHED_RATE_LIMITED: 0, SHED_QUEUE_FULL: 0, SHED_TIMEOUT: 0}
+
+    def deadline(self) -> Optional[float]:
+        """Latest monotonic time an update arriving now may start, None if unbounded"""
+        return time.monotonic() + self.max_wait if self.max_wait else None
+
+    def _record(self, priority: int, reason: Optional[str]):
+        if reason is None:
+            self.accepted += 1
+            ADMISSIONS.inc(kind=_kind(priority), outcome='accepted')
+        else:
+            self.shed[reason] += 1
+            ADMISSIONS.inc(kind=_kind(priority), outcome=reason)
+
+    def check_rate(self, user_id: str, priority: int = PRIORITY_MESSAGE) -> bool:
+        """Take a token from the user's bucket; False (and counted as shed) when they are over the rate"""
+        if not self.user_rate:
+            return True
+        now = time.monotonic()
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            if len(self._users) > MAX_TRACKED_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        if bucket.take(now):
+            self._record(priority, SHED_RATE_LIMITED)
+            return False
+        return True
+
+    def should_notify(self, user_id: Optional[str]) -> bool:
+        """Whether a shed update from this user should get a reply, at most one per interval"""
+        if user_id is None:
+            return False
+        now = time.monotonic()
+        last = self._notified.get(user_id)
+        if last is not None and now - last < self.notify_interval:
+            return False
+        self._notified[user_id] = now
+        self._notified.move_to_end(user_id)
+        if len(self._notified) > MAX_TRACKED_USERS:
+            self._notified.popitem(last=False)
+        return True
+
+    def _displace(self, priority: int) -> bool:
+        """Shed the lowest-priority, newest waiter if it ranks below ``priority``"""
+        waiting = [entry for entry in self._waiters if not entry[2].done()]
+        if not waiting:
+            return False
+        victim = max(waiting, key=lambda entry: (entry[0], entry[1]))
+        if victim[0] <= priority:
+            return False
+        victim[2].set_result(SHED_QUEUE_FULL)
+        self._queued -= 1
+        return True
+
+    async def acquire(self, priority: int = PRIORITY_MESSAGE, deadline: Optional[float] = None) -> Optional[str]:
+        """Wait for a slot: None once one is held (call release), otherwise the reason the update is shed"""
+        if self._in_flight < self.max_in_flight and not self._queued:
+            self._in_flight += 1
+            self._record(priority, None)
+            return None
+
+        if self.max_queue is not None and self._queued >= self.max_queue and not self._displace(priority):
+            self._record(priority, SHED_QUEUE_FULL)
+            return SHED_QUEUE_FULL
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._queued += 1
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait({future}, timeout=timeout)
+        except asyncio.CancelledError:
+            if future.done() and future.result() is None:
+                self.release()
+            elif not future.done():
+                future.cancel()
+                self._queued -= 1
+            raise
+
+        if future.done():
+            reason = future.result()
+        else:
+            future.cancel()
+            self._queued -= 1
+            reason = SHED_TIMEOUT
+        self._record(priority, reason)
+        return reason
+
+    def release(self):
+        """Hand the slot to the highest-priority waiter, or free it"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def get_stats(self) -> dict:
+        """Slots in use, queue length and accept/shed counters"""
+        return {
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queued': self._queued,
+            'accepted': self.accepted,
+            'shed': dict(self.shed)
+        }
@@ -2,14 +2,34 @@ import json
 from datetime import datetime
 from typing import Dict, List, Optional
 from logger import logger
+from voiceflow_client import ParsedResponse
+from interaction_log import InteractionLogWriter
+from metrics import LatencyHistogram
 
 class Analytics:
-    def __init__(self):
+    def __init__(self, log_writer: Optional[InteractionLogWriter] = None):
         self.user_metrics: Dict[str, dict] = {}
-        self.conversation_logs: List[dict] = []
+        self.user_latency: Dict[str, LatencyHistogram] = {}
+        # Running totals so global metrics never scan per-user data
+        self.totals = {
+            'total_messages': 0,
+            'total_button_clicks': 0,
+            'total_images': 0
+        }
+        self.latency = LatencyHistogram()
+        self.log_writer = log_writer or InteractionLogWriter()
+
+    def start(self):
+        """Start the background interaction log writer"""
+        self.log_writer.start()
 
-    def log_interaction(self, user_id: str, user_message: str, bot_response: dict, latency: float):
-        """Log a single interaction between user and bot"""
+    def close(self):
+        """Flush queued interaction logs to disk"""
+        self.log_writer.close()
+
+    def log_interaction(self, user_id: str, user_message: str, bot_response: ParsedResponse, latency: float,
+                        button_click: bool = False):
+        """Log a single interaction between user and bot; ``button_click`` marks turns started by a button"""
         timestamp = datetime.now().isoformat()
         
         # Update user metrics
@@ -22,57 +42,100 @@ class Analytics:
                 'button_clicks': 0,
                 'images_received': 0
             }
+            self.user_latency[user_id] = LatencyHistogram()
         
         metrics = self.user_metrics[user_id]
         metrics['total_messages'] += 1
         metrics['total_interactions'] += 1
         metrics['last_interaction'] = timestamp
+        self.totals['total_messages'] += 1
         
-        if bot_response.get('image_url'):
+        if bot_response.image_url:
             metrics['images_received'] += 1
-        if user_message in (bot_response.get('buttons') or []):
+            self.totals['total_images'] += 1
+        if button_click:
             metrics['button_clicks'] += 1
+            self.totals['total_button_clicks'] += 1
+
+        self.latency.observe(latency)
+        self.user_latency[user_id].observe(latency)
 
-        # Log conversation details
-        interaction_log = {
+        # Queue conversation details for the interaction log
+        self.log_writer.write({
             'timestamp': timestamp,
             'user_id': user_id,
             'user_message': user_message,
             'bot_response': {
-                'text': bot_response.get('text'),
-                'has_buttons': bool(bot_response.get('buttons')),
-                'has_image': bool(bot_response.get('image_url'))
+                'text': bot_response.text,
+                'has_buttons': bool(bot_response.buttons),
+                'has_image': bool(bot_response.image_url)
             },
+            'button_click': button_click,
             'latency': latency
-        }
-        
-        self.conversation_logs.append(interaction_log)
+        })
         logger.info(f"Interaction logged - User: {user_id}, Message: {user_message[:50]}...")
 
     def get_user_metrics(self, user_id: str) -> Optional[dict]:
         """Get metrics for a specific user"""
         return self.user_metrics.get(user_id)
 
-    def get_global_metrics(self) -> dict:
-        """Get global usage metrics"""
-        total_users = len(self.user_metrics)
-        total_messages = sum(m['total_messages'] for m in self.user_metrics.values())
-        total_button_clicks = sum(m['button_clicks'] for m in self.user_metrics.values())
-        total_images = sum(m['images_received'] for m in self.user_metrics.values())
+    def get_user_latency(self, user_id: str) -> Optional[dict]:
+        """Get latency percentiles for a specific user"""
+        histogram = self.user_latency.get(user_id)
+        return histogram.snapshot() if histogram else None
 
+    def get_global_state(self) -> dict:
+        """Mergeable counters behind the global metrics, for combining across processes"""
         return {
-            'total_users': total_users,
-            'total_messages': total_messages,
-            'total_button_clicks': total_button_clicks,
-            'total_images': total_images,
-            'average_messages_per_user': total_messages / total_users if total_users > 0 else 0
+            'total_users': len(self.user_metrics),
+            'totals': dict(self.totals),
+            'latency': self.latency
         }
 
+    def get_global_metrics(self) -> dict:
+        """Get global usage metrics"""
+        return summarize_global_metrics([self.get_global_state()])
+
     def export_logs(self, file_path: str = 'conversation_logs.json'):
-        """Export conversation logs to a JSON file"""
+        """Export the on-disk interaction log to a JSON array file, streaming record by record"""
         try:
+            count = 0
             with open(file_path, 'w') as f:
-                json.dump(self.conversation_logs, f, indent=2)
-            logger.info(f"Conversation logs exported to {file_path}")
+                f.write('[')
+                for record in self.log_writer.iter_records():
+                    f.write(',\n' if count else '\n')
+                    f.write(json.dumps(record))
+                    count += 1
+                f.write('\n]\n')
+            logger.info(f"Exported {count} conversation logs to {file_path}")
         except Exception as e:
             logger.error(f"Error exporting logs: {str(e)}")
+
+    def export_columnar(self, directory: str = 'exports/interactions') -> int:
+        """Export the on-disk interaction log as memory-mappable columns, see interaction_export"""
+        from interaction_export import export_columnar
+        rows = export_columnar(self.log_writer.iter_records(), directory)
+        logger.info(f"Exported {rows} interactions to {directory}")
+        return rows
+
+def summarize_global_metrics(states: List[dict]) -> dict:
+    """
+    Global usage metrics from one or more ``get_global_state()`` snapshots.
+    Users are counted once per snapshot, so each user must live in one process.
+    """
+    total_users = sum(state['total_users'] for state in states)
+    totals = {'total_messages': 0, 'total_button_clicks': 0, 'total_images': 0}
+    latency = LatencyHistogram()
+    for state in states:
+        for name in totals:
+            totals[name] += state['totals'][name]
+        latency.merge(state['latency'])
+
+    return {
+        'total_users': total_users,
+        'total_messages': totals['total_messages'],
+        'total_button_clicks': totals['total_button_clicks'],
+        'total_images': totals['total_images'],
+        'average_messages_per_user': totals['total_messages'] / total_users if total_users > 0 else 0,
+        'latency': latency.snapshot()
+    }
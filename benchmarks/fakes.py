@@ -0,0 +1,178 @@
+"""
+Local stand-ins for the Voiceflow runtime and the Telegram Bot API.
+
+Both are tornado apps with configurable latency so the bot can be driven
+end to end without network access or real credentials. The Voiceflow fake
+also serves the streaming interact endpoint, spreading the same latency
+over a number of server-sent completion chunks.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from typing import Dict, Optional
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+# Relative weights of the response shapes returned by the fake Voiceflow
+DEFAULT_TRACE_MIX = {'text': 0.5, 'choice': 0.25, 'card': 0.15, 'carousel': 0.1}
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse 'text=0.5,choice=0.2' into a weight mapping"""
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(DEFAULT_TRACE_MIX)
+    if unknown:
+        raise ValueError(f"Unknown trace types: {', '.join(sorted(unknown))}")
+    return mix
+
+def build_traces(kind: str, image_base: str) -> list:
+    """Voiceflow trace list for one response shape"""
+    text = {'type': 'text', 'payload': {'message': 'Here is what I found for you. ' * 3}}
+    if kind == 'text':
+        return [text]
+    if kind == 'choice':
+        return [text, {'type': 'choice', 'payload': {'buttons': [
+            {'name': f'Option {i}', 'request': {'type': 'text', 'payload': f'Option {i}'}} for i in range(1, 5)
+        ]}}]
+    if kind == 'card':
+        return [{'type': 'card', 'payload': {
+            'title': 'Featured product',
+            'description': 'A very good product',
+            'image': f'{image_base}/{random.randrange(20)}.jpg',
+            'buttons': [{'name': 'Buy now'}, {'name': 'More like this'}]
+        }}]
+    return [{'type': 'carousel', 'payload': {'items': [
+        {
+            'title': f'Product {i}',
+            'description': 'Carousel item',
+            'image': f'{image_base}/{random.randrange(20)}.jpg',
+            'buttons': [{'name': f'Pick {i}'}]
+        }
+        for i in range(5)
+    ]}}]
+
+def _sleep_time(mean: float, jitter: float) -> float:
+    return max(0.0, random.gauss(mean, mean * jitter)) if mean else 0.0
+
+class FakeVoiceflowHandler(tornado.web.RequestHandler):
+    """POST /state/user/{id}/interact returning a weighted random trace list"""
+
+    def initialize(self, latency: float, jitter: float, mix: Dict[str, float], image_base: str):
+        self.latency = latency
+        self.jitter = jitter
+        self.mix = mix
+        self.image_base = image_base
+
+    async def post(self, user_id: str):
+        await asyncio.sleep(_sleep_time(self.latency, self.jitter))
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(build_traces(kind, self.image_base)))
+
+class FakeVoiceflowStreamHandler(FakeVoiceflowHandler):
+    """POST /v2/project/{id}/user/{id}/interact/stream answering with server-sent events"""
+
+    def initialize(self, chunks: int, **kwargs):
+        super().initialize(**kwargs)
+        self.chunks = chunks
+
+    async def _event(self, event: str, data: dict):
+        self.write(f"event: {event}\ndata: {json.dumps(data)}\n\n")
+        await self.flush()
+
+    async def post(self, project_id: str, user_id: str):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        traces = build_traces(kind, self.image_base)
+        delay = _sleep_time(self.latency, self.jitter) / self.chunks
+
+        if traces[0]['type'] == 'text':
+            # Text replies are generated: stream them as completion chunks
+            words = traces.pop(0)['payload']['message'].split(' ')
+            step = max(1, -(-len(words) // self.chunks))
+            await self._event('trace', {'type': 'completion', 'payload': {'state': 'start'}})
+            for i in range(0, len(words), step):
+                await asyncio.sleep(delay)
+                content = ' '.join(words[i:i + step]) + ' '
+                await self._event('trace', {'type': 'completion', 'payload': {'state': 'content', 'content': content}})
+            await self._event('trace', {'type': 'completion', 'payload': {'state': 'end'}})
+        else:
+            await asyncio.sleep(delay * self.chunks)
+
+        for trace in traces:
+            await self._event('trace', trace)
+        await self._event('end', {})
+
+class FakeTelegramHandler(tornado.web.RequestHandler):
+    """POST /bot{token}/{method} answering the Bot API calls the bot makes"""
+
+    message_ids = itertools.count(1)
+
+    def initialize(self, latency: float, jitter: float):
+        self.latency = latency
+        self.jitter = jitter
+
+    def _message(self, chat_id: str, **extra) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}
+        }
+        message.update(extra)
+        return message
+
+    @staticmethod
+    def _photo(source: str) -> list:
+        file_id = source if not source.startswith('http') else f"file-{abs(hash(source))}"
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}]
+
+    async def post(self, token: str, method: str):
+        await asyncio.sleep(_sleep_time(self.latency, self.jitter))
+        arg = self.get_body_argument
+        chat_id: Optional[str] = arg('chat_id', None)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'sendMessage':
+            result = self._message(chat_id, text=arg('text', ''))
+        elif method == 'editMessageText':
+            result = self._message(chat_id, text=arg('text', ''))
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, photo=self._photo(arg('photo', '')))
+        elif method == 'sendMediaGroup':
+            media = json.loads(arg('media', '[]'))
+            result = [self._message(chat_id, photo=self._photo(item['media'])) for item in media]
+        else:
+            result = True
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'ok': True, 'result': result}))
+
+def make_app(vf_latency: float, tg_latency: float, jitter: float, mix: Dict[str, float], port: int,
+             chunks: int = 10) -> tornado.web.Application:
+    voiceflow = dict(latency=vf_latency, jitter=jitter, mix=mix, image_base=f'http://127.0.0.1:{port}/img')
+    return tornado.web.Application([
+        (r'/state/user/([^/]+)/interact', FakeVoiceflowHandler, voiceflow),
+        (r'/v2/project/([^/]+)/user/([^/]+)/interact/stream', FakeVoiceflowStreamHandler, dict(chunks=chunks, **voiceflow)),
+        (r'/bot([^/]+)/(\w+)', FakeTelegramHandler, dict(latency=tg_latency, jitter=jitter)),
+    ])
+
+def serve(port: int, vf_latency: float, tg_latency: float, jitter: float, mix: Dict[str, float],
+          chunks: int = 10, ready=None):
+    """Run both fakes on one port until the process is terminated"""
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    async def main():
+        server = HTTPServer(make_app(vf_latency, tg_latency, jitter, mix, port, chunks))
+        server.listen(port, '127.0.0.1')
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
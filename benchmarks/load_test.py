@@ -0,0 +1,238 @@
+"""
+End-to-end load test: N simulated users talking to the bot through
+TelegramHandler, with Voiceflow and Telegram replaced by local fakes.
+
+    python -m benchmarks.load_test --users 200 --turns 20 --vf-latency 0.3
+
+Reports throughput, per-turn latency and time-to-first-reply percentiles
+and memory growth. ``--stream`` switches the bot to Voiceflow's streaming
+endpoint so the two time-to-first-reply figures can be compared.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Credentials must exist before config is imported; the fakes ignore them
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123:bench')
+os.environ.setdefault('VOICEFLOW_API_KEY', 'bench')
+os.environ.setdefault('VOICEFLOW_PROJECT_ID', 'bench')
+
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+from benchmarks.fakes import DEFAULT_TRACE_MIX, parse_mix, serve
+from interaction_log import InteractionLogWriter
+from analytics import Analytics
+from metrics import LatencyHistogram
+from rate_limiter import PrioritizedRateLimiter
+from telegram_handler import TelegramHandler
+
+# Per-request logging would dominate the measurement
+logging.getLogger().setLevel(logging.WARNING)
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux), 0 where unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class LoadTest:
+    def __init__(self, args, port: int, log_dir: str):
+        self.args = args
+        self.handler = TelegramHandler()
+        self.handler.voiceflow_client.base_url = f'http://127.0.0.1:{port}'
+        self.handler.analytics = Analytics(InteractionLogWriter(path=os.path.join(log_dir, 'interactions.jsonl')))
+        self.handler.media_cache.path = None
+        self.handler.streaming = args.stream
+        self.handler.edit_interval = args.edit_interval
+        self._time_first_send()
+
+        if args.real_limits:
+            rate_limiter = PrioritizedRateLimiter()
+        else:
+            # Keep the limiter in the path but never let it throttle
+            rate_limiter = PrioritizedRateLimiter(overall_rate=1e9, chat_rate=1e9, chat_burst=1e9, group_rate=1e9)
+        self.bot = ExtBot(
+            token=os.environ['TELEGRAM_BOT_TOKEN'],
+            base_url=f'http://127.0.0.1:{port}/bot',
+            request=HTTPXRequest(connection_pool_size=args.pool_size),
+            rate_limiter=rate_limiter
+        )
+        self.context = SimpleNamespace(bot=self.bot)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.latency = LatencyHistogram()
+        self.first_reply = LatencyHistogram()
+        self._first_send = {}
+        self.turns = 0
+        self.errors = 0
+
+    def _time_first_send(self):
+        """Note when each chat gets its first Bot API call of the turn"""
+        call_bot = self.handler._call_bot
+
+        async def timed_call_bot(stage, method, **kwargs):
+            self._first_send.setdefault(kwargs.get('chat_id'), time.perf_counter())
+            return await call_bot(stage, method, **kwargs)
+
+        self.handler._call_bot = timed_call_bot
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    def _message_update(self, user_id: int, text: str) -> Update:
+        return Update.de_json({
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+                'text': text
+            }
+        }, self.bot)
+
+    def _callback_update(self, user_id: int, data: str) -> Update:
+        return Update.de_json({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'chat_instance': str(user_id),
+                'from': self._user(user_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'Pick one'
+                }
+            }
+        }, self.bot)
+
+    async def _user_session(self, user_id: int):
+        for turn in range(self.args.turns):
+            if turn and random.random() < self.args.callback_ratio:
+                update = self._callback_update(user_id, f't:Option {random.randint(1, 4)}')
+                handle = self.handler.handle_callback_query
+            else:
+                update = self._message_update(user_id, f'Message {turn} from {user_id}')
+                handle = self.handler.handle_message
+            self._first_send.pop(user_id, None)
+            start = time.perf_counter()
+            try:
+                await handle(update, self.context)
+            except Exception:
+                self.errors += 1
+            self.latency.observe(time.perf_counter() - start)
+            if user_id in self._first_send:
+                self.first_reply.observe(self._first_send[user_id] - start)
+            self.turns += 1
+            if self.args.think_time:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+    async def run(self) -> dict:
+        await self.bot.initialize()
+        await self.handler.start()
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._user_session(1000 + i) for i in range(self.args.users)))
+        finally:
+            elapsed = time.perf_counter() - started
+            rss_after = rss_bytes()
+            await self.handler.close()
+            await self.bot.shutdown()
+
+        return {
+            'users': self.args.users,
+            'turns': self.turns,
+            'errors': self.errors,
+            'seconds': round(elapsed, 3),
+            'turns_per_second': round(self.turns / elapsed, 1) if elapsed else 0.0,
+            'stream': self.args.stream,
+            'latency': self.latency.snapshot(),
+            'first_reply': self.first_reply.snapshot(),
+            'rss_start_mb': round(rss_before / 2 ** 20, 1),
+            'rss_end_mb': round(rss_after / 2 ** 20, 1),
+            'rss_growth_kb_per_user': round((rss_after - rss_before) / 1024 / max(self.args.users, 1), 1),
+            'sessions': len(self.handler.session_manager),
+            'media_cache': self.handler.media_cache.get_stats(),
+            'keyboards': self.handler.keyboards.get_stats(),
+            'voiceflow': self.handler.voiceflow_client.get_stats()
+        }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100, help='simulated users talking at once')
+    parser.add_argument('--turns', type=int, default=10, help='messages or button presses per user')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean pause between a user\'s turns (s)')
+    parser.add_argument('--callback-ratio', type=float, default=0.3, help='share of turns that are button presses')
+    parser.add_argument('--vf-latency', type=float, default=0.2, help='mean fake Voiceflow latency (s)')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='mean fake Telegram latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.3, help='latency standard deviation as a share of the mean')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_TRACE_MIX,
+                        help='response shapes, e.g. text=0.5,choice=0.25,card=0.15,carousel=0.1')
+    parser.add_argument('--stream', action='store_true', help='use Voiceflow\'s streaming endpoint')
+    parser.add_argument('--chunks', type=int, default=10, help='completion chunks per streamed reply')
+    parser.add_argument('--edit-interval', type=float, default=1.0, help='min seconds between streamed edits')
+    parser.add_argument('--pool-size', type=int, default=256, help='Telegram HTTP connection pool size')
+    parser.add_argument('--real-limits', action='store_true', help='apply Telegram\'s real flood limits')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args(argv)
+
+def print_report(report: dict):
+    latency = report['latency']
+    print(f"{report['users']} users, {report['turns']} turns in {report['seconds']}s "
+          f"({report['turns_per_second']} turns/s), {report['errors']} errors")
+    print(f"Turn latency: p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  "
+          f"p99 {latency['p99']:.3f}s")
+    first = report['first_reply']
+    print(f"First reply ({'streaming' if report['stream'] else 'full response'}): p50 {first['p50']:.3f}s  "
+          f"p95 {first['p95']:.3f}s  p99 {first['p99']:.3f}s")
+    print(f"Memory: {report['rss_start_mb']} MB -> {report['rss_end_mb']} MB "
+          f"({report['rss_growth_kb_per_user']} KB per user)")
+    print(f"Media cache: {report['media_cache']}")
+    print(f"Keyboards: {report['keyboards']}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    port = free_port()
+    ready = multiprocessing.Event()
+    fakes = multiprocessing.Process(
+        target=serve,
+        args=(port, args.vf_latency, args.tg_latency, args.jitter, args.mix, args.chunks, ready),
+        daemon=True
+    )
+    fakes.start()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError("Fake servers did not start")
+        with tempfile.TemporaryDirectory() as log_dir:
+            report = asyncio.run(LoadTest(args, port, log_dir).run())
+    finally:
+        fakes.terminate()
+        fakes.join()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+from typing import Dict, List, Optional, Tuple
+from config import COALESCE_WINDOW, COALESCE_MAX_MESSAGES
+
+class MessageCoalescer:
+    """
+    Per-user buffer that folds rapid-fire messages into one Voiceflow turn.
+    Buffers are kept per chat as well, so text sent in one chat is never
+    merged into a turn answered in another.
+
+    A turn opens the user's buffer, waits ``window`` seconds, then drains it.
+    Messages absorbed while the buffer is open (during the wait or while the
+    Voiceflow call is in flight) are joined and sent as the next turn.
+    The update scheduler opens the buffer and waits before the turn takes a
+    worker slot. A window of 0 disables coalescing.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_messages: int = COALESCE_MAX_MESSAGES):
+        self.window = window
+        self.max_messages = max_messages
+        self._buffers: Dict[Tuple[str, int], List[str]] = {}
+        self.messages = 0
+        self.turns = 0
+        self.calls_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def open(self, user_id: str, chat_id: int, text: str):
+        """Start collecting messages for a user's turn in a chat"""
+        self._buffers[user_id, chat_id] = [text]
+        self.messages += 1
+
+    def is_open(self, user_id: str, chat_id: int) -> bool:
+        return (user_id, chat_id) in self._buffers
+
+    def absorb(self, user_id: str, chat_id: int, text: str) -> bool:
+        """Add a message to an open buffer; False if the user has none in this chat or it is full"""
+        buffer = self._buffers.get((user_id, chat_id))
+        if buffer is None or len(buffer) >= self.max_messages:
+            return False
+        buffer.append(text)
+        self.messages += 1
+        return True
+
+    def drain(self, user_id: str, chat_id: int) -> Optional[str]:
+        """Take the buffered messages as one text, None when nothing is waiting"""
+        buffer = self._buffers.get((user_id, chat_id))
+        if not buffer:
+            return None
+        self._buffers[user_id, chat_id] = []
+        self.turns += 1
+        self.calls_saved += len(buffer) - 1
+        return '\n'.join(buffer)
+
+    def close(self, user_id: str, chat_id: int):
+        self._buffers.pop((user_id, chat_id), None)
+
+    def get_stats(self) -> dict:
+        """Messages received versus Voiceflow turns made"""
+        return {
+            'window': self.window,
+            'open': len(self._buffers),
+            'messages': self.messages,
+            'turns': self.turns,
+            'calls_saved': self.calls_saved
+        }
@@ -10,7 +10,96 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 # Voiceflow configuration
 VOICEFLOW_API_KEY = os.getenv('VOICEFLOW_API_KEY')
 VOICEFLOW_PROJECT_ID = os.getenv('VOICEFLOW_PROJECT_ID')
-VOICEFLOW_API_BASE_URL = 'https://general-runtime.voiceflow.com'
+VOICEFLOW_API_BASE_URL = os.getenv('VOICEFLOW_API_BASE_URL', 'https://general-runtime.voiceflow.com')
+
+# Voiceflow HTTP connection pool
+VOICEFLOW_TIMEOUT = float(os.getenv('VOICEFLOW_TIMEOUT', '10'))
+VOICEFLOW_HTTP2 = os.getenv('VOICEFLOW_HTTP2', 'true').lower() == 'true'
+VOICEFLOW_MAX_CONNECTIONS = int(os.getenv('VOICEFLOW_MAX_CONNECTIONS', '200'))
+VOICEFLOW_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('VOICEFLOW_MAX_KEEPALIVE_CONNECTIONS', '50'))
+VOICEFLOW_KEEPALIVE_EXPIRY = float(os.getenv('VOICEFLOW_KEEPALIVE_EXPIRY', '60'))
+
+# Voiceflow resilience: adaptive timeout (VOICEFLOW_TIMEOUT is the ceiling), retries and circuit breaker
+VOICEFLOW_MIN_TIMEOUT = float(os.getenv('VOICEFLOW_MIN_TIMEOUT', '2'))
+VOICEFLOW_TIMEOUT_MULTIPLIER = float(os.getenv('VOICEFLOW_TIMEOUT_MULTIPLIER', '3'))
+VOICEFLOW_MAX_RETRIES = int(os.getenv('VOICEFLOW_MAX_RETRIES', '2'))
+VOICEFLOW_RETRY_BACKOFF = float(os.getenv('VOICEFLOW_RETRY_BACKOFF', '0.2'))  # Seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', '30'))  # Seconds
+BREAKER_FAILURE_RATIO = float(os.getenv('BREAKER_FAILURE_RATIO', '0.5'))  # Share of calls in the window
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '15'))  # Seconds
+
+# Outbound Telegram limits (messages per second)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+
+# Telegram file_id cache for Voiceflow images
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', '5000'))
+MEDIA_CACHE_PATH = os.getenv('MEDIA_CACHE_PATH')  # Optional JSON file kept across restarts
+
+# Inline keyboard caches
+BUTTON_TABLE_SIZE = int(os.getenv('BUTTON_TABLE_SIZE', '10000'))
+KEYBOARD_CACHE_SIZE = int(os.getenv('KEYBOARD_CACHE_SIZE', '1000'))
+
+# Update scheduling
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1000'))
+
+# Admission control: updates beyond these limits get a "busy" reply instead of a Voiceflow call
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '200'))  # Updates waiting for a worker
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '5'))  # Seconds, 0 waits forever
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '1'))  # Turns per second per user, 0 disables
+ADMISSION_USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '5'))
+ADMISSION_NOTIFY_INTERVAL = float(os.getenv('ADMISSION_NOTIFY_INTERVAL', '10'))  # Min seconds between busy replies
+
+# Session store
+SESSION_MAX_USERS = int(os.getenv('SESSION_MAX_USERS', '10000'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '86400'))  # Seconds
+SESSION_HISTORY_SIZE = int(os.getenv('SESSION_HISTORY_SIZE', '20'))
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')  # 'memory' or 'sqlite'
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '1.0'))  # Seconds
+
+# Interaction log
+INTERACTION_LOG_PATH = os.getenv('INTERACTION_LOG_PATH', 'logs/interactions.jsonl')
+INTERACTION_LOG_MAX_BYTES = int(os.getenv('INTERACTION_LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+INTERACTION_LOG_ROTATE_INTERVAL = float(os.getenv('INTERACTION_LOG_ROTATE_INTERVAL', '86400'))  # Seconds
+INTERACTION_LOG_COMPRESS = os.getenv('INTERACTION_LOG_COMPRESS', 'true').lower() == 'true'
+INTERACTION_LOG_QUEUE_SIZE = int(os.getenv('INTERACTION_LOG_QUEUE_SIZE', '10000'))
+
+# Message coalescing (opt-in)
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))  # Seconds, 0 disables
+COALESCE_MAX_MESSAGES = int(os.getenv('COALESCE_MAX_MESSAGES', '10'))
+
+# Streaming replies (opt-in): progressive message edits from Voiceflow's SSE endpoint
+VOICEFLOW_STREAMING = os.getenv('VOICEFLOW_STREAMING', 'false').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))  # Min seconds between edits
+
+# Horizontal sharding: updates are routed to worker processes by user id (1 = single process)
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+SHARD_STATS_INTERVAL = float(os.getenv('SHARD_STATS_INTERVAL', '2.0'))  # Seconds between worker stats reports
+
+# Multi-tenancy: several bot/Voiceflow project pairs served by one process (unset = the single bot above)
+TENANTS = os.getenv('TENANTS')  # JSON list of tenants, or the path of a JSON file holding one
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '256'))  # Bot API connections shared by all tenants
+
+# Server configuration
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+PORT = int(os.getenv('PORT', '10000'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL Telegram posts updates to
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+
+# Turn tracing and the /debug endpoints (disabled unless DEBUG_TOKEN is set)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.1'))  # Share of turns traced, 0 disables
+TRACE_MAX_TRACES = int(os.getenv('TRACE_MAX_TRACES', '50'))  # Slowest traces kept
+TRACE_MAX_AGE = float(os.getenv('TRACE_MAX_AGE', '3600'))  # Seconds a kept trace stays listed
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))  # Seconds between stack samples
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
 
 # Application configuration
 LOG_LEVEL = 'INFO'
@@ -0,0 +1,208 @@
+"""
+Columnar export of the interaction log and vectorized reports over it.
+
+    python interaction_export.py export --out exports/interactions
+    python interaction_export.py report exports/interactions
+
+An export is a directory with one .npy file per column plus meta.json.
+Columns are built from the JSONL log a chunk at a time and read back
+memory-mapped, so both steps run in bounded memory.
+"""
+import argparse
+import json
+import os
+import shutil
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+from interaction_log import InteractionLogWriter
+from metrics import LATENCY_BUCKETS, LatencyHistogram
+from config import INTERACTION_LOG_PATH
+
+# Column name, array.array typecode used while building, NumPy dtype on disk
+COLUMNS = (
+    ('timestamp', 'd', 'float64'),   # Unix seconds
+    ('user', 'I', 'uint32'),         # Index into meta.json "users"
+    ('latency', 'f', 'float32'),     # Seconds
+    ('has_buttons', 'b', 'bool'),
+    ('has_image', 'b', 'bool'),
+    ('button_click', 'b', 'bool'),
+)
+
+# Rows buffered in memory while exporting, and processed at a time while reporting
+CHUNK_ROWS = 100_000
+
+HOUR = 3600
+DAY = 86400
+
+def _write_npy(raw_path: str, npy_path: str, dtype: str, rows: int):
+    """Prefix raw little-endian column data with an .npy header"""
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (rows,)}
+    with open(npy_path, 'wb') as dst, open(raw_path, 'rb') as src:
+        np.lib.format.write_array_header_1_0(dst, header)
+        shutil.copyfileobj(src, dst)
+    os.remove(raw_path)
+
+def export_columnar(records: Iterable[dict], directory: str) -> int:
+    """Write interaction records as a columnar export, returning the number of rows"""
+    os.makedirs(directory, exist_ok=True)
+    users: Dict[str, int] = {}
+    buffers = {name: array(code) for name, code, _ in COLUMNS}
+    raw_files = {name: open(os.path.join(directory, f"{name}.raw"), 'wb') for name, _, _ in COLUMNS}
+
+    def flush():
+        for name, buffer in buffers.items():
+            buffer.tofile(raw_files[name])
+            del buffer[:]
+
+    rows = 0
+    try:
+        for record in records:
+            response = record.get('bot_response') or {}
+            user = users.setdefault(str(record['user_id']), len(users))
+            buffers['timestamp'].append(datetime.fromisoformat(record['timestamp']).timestamp())
+            buffers['user'].append(user)
+            buffers['latency'].append(record.get('latency') or 0.0)
+            buffers['has_buttons'].append(bool(response.get('has_buttons')))
+            buffers['has_image'].append(bool(response.get('has_image')))
+            buffers['button_click'].append(bool(record.get('button_click')))
+            rows += 1
+            if rows % CHUNK_ROWS == 0:
+                flush()
+        flush()
+    finally:
+        for f in raw_files.values():
+            f.close()
+
+    for name, _, dtype in COLUMNS:
+        _write_npy(os.path.join(directory, f"{name}.raw"), os.path.join(directory, f"{name}.npy"), dtype, rows)
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({
+            'rows': rows,
+            'columns': {name: dtype for name, _, dtype in COLUMNS},
+            'users': list(users),
+            'exported_at': datetime.now(timezone.utc).isoformat()
+        }, f)
+    return rows
+
+def load_columnar(directory: str) -> Tuple[Dict[str, np.ndarray], dict]:
+    """Memory-mapped columns and metadata of an export"""
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {
+        name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+        for name in meta['columns']
+    }
+    return columns, meta
+
+def _chunks(columns: Dict[str, np.ndarray], rows: int):
+    for start in range(0, rows, CHUNK_ROWS):
+        yield {name: column[start:start + CHUNK_ROWS] for name, column in columns.items()}
+
+def _iso(seconds: int) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+def latency_by_hour(columns: Dict[str, np.ndarray], rows: int) -> List[dict]:
+    """Latency percentiles for each UTC hour, from per-hour bucket counts"""
+    bounds = np.asarray(LATENCY_BUCKETS)
+    width = len(bounds) + 1
+    counts: Dict[int, np.ndarray] = {}
+    sums: Dict[int, float] = {}
+    for chunk in _chunks(columns, rows):
+        latency = chunk['latency'].astype(np.float64)
+        hours, inverse = np.unique(chunk['timestamp'] // HOUR, return_inverse=True)
+        buckets = np.searchsorted(bounds, latency, side='left')
+        chunk_counts = np.bincount(inverse * width + buckets, minlength=len(hours) * width).reshape(-1, width)
+        chunk_sums = np.bincount(inverse, weights=latency, minlength=len(hours))
+        for i, hour in enumerate(hours.astype(np.int64).tolist()):
+            counts[hour] = counts.get(hour, 0) + chunk_counts[i]
+            sums[hour] = sums.get(hour, 0.0) + chunk_sums[i]
+
+    report = []
+    for hour in sorted(counts):
+        histogram = LatencyHistogram()
+        histogram.counts = counts[hour].tolist()
+        histogram.count = sum(histogram.counts)
+        histogram.sum = sums[hour]
+        report.append({'hour': _iso(hour * HOUR), **histogram.snapshot()})
+    return report
+
+def daily_activity(columns: Dict[str, np.ndarray], rows: int, users: int) -> List[dict]:
+    """Active users, turns and button-click rate for each UTC day"""
+    seen = np.empty(0, dtype=np.int64)
+    turns: Dict[int, int] = {}
+    clicks: Dict[int, int] = {}
+    for chunk in _chunks(columns, rows):
+        days = (chunk['timestamp'] // DAY).astype(np.int64)
+        # One key per (day, user) pair; distinct pairs are the only state that grows
+        seen = np.union1d(seen, days * max(users, 1) + chunk['user'])
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        day_turns = np.bincount(inverse, minlength=len(unique_days))
+        day_clicks = np.bincount(inverse, weights=chunk['button_click'], minlength=len(unique_days))
+        for i, day in enumerate(unique_days.tolist()):
+            turns[day] = turns.get(day, 0) + int(day_turns[i])
+            clicks[day] = clicks.get(day, 0) + int(day_clicks[i])
+
+    active_days, active_users = np.unique(seen // max(users, 1), return_counts=True)
+    active = dict(zip(active_days.tolist(), active_users.tolist()))
+    return [
+        {
+            'day': _iso(day * DAY)[:10],
+            'active_users': active.get(day, 0),
+            'turns': turns[day],
+            'button_clicks': clicks[day],
+            'button_click_rate': clicks[day] / turns[day]
+        }
+        for day in sorted(turns)
+    ]
+
+def build_report(directory: str) -> dict:
+    """All aggregates for an export"""
+    columns, meta = load_columnar(directory)
+    rows = meta['rows']
+    return {
+        'rows': rows,
+        'users': len(meta['users']),
+        'hourly_latency': latency_by_hour(columns, rows),
+        'daily': daily_activity(columns, rows, len(meta['users']))
+    }
+
+def print_report(report: dict):
+    print(f"{report['rows']} interactions from {report['users']} users\n")
+    print("Day         Active users   Turns   Button clicks")
+    for day in report['daily']:
+        print(f"{day['day']}  {day['active_users']:>12}  {day['turns']:>6}   "
+              f"{day['button_clicks']:>6} ({day['button_click_rate']:.1%})")
+    print("\nHour (UTC)                   Turns     p50      p95      p99")
+    for hour in report['hourly_latency']:
+        print(f"{hour['hour']}  {hour['count']:>6}  {hour['p50']:.3f}s  {hour['p95']:.3f}s  {hour['p99']:.3f}s")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='convert the JSONL interaction log to columns')
+    export.add_argument('--log', nargs='+', default=[INTERACTION_LOG_PATH],
+                        help='interaction log path(s), e.g. one per worker process')
+    export.add_argument('--out', default='exports/interactions', help='export directory')
+
+    report = commands.add_parser('report', help='aggregate an export')
+    report.add_argument('directory', help='export directory')
+    report.add_argument('--json', action='store_true', help='print the report as JSON')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        records = (record for path in args.log for record in InteractionLogWriter(path).iter_records())
+        rows = export_columnar(records, args.out)
+        print(f"Exported {rows} interactions to {args.out}")
+    else:
+        result = build_report(args.directory)
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_report(result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+from typing import Iterator, List, Optional
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from logger import logger
+from config import (
+    INTERACTION_LOG_PATH,
+    INTERACTION_LOG_MAX_BYTES,
+    INTERACTION_LOG_ROTATE_INTERVAL,
+    INTERACTION_LOG_COMPRESS,
+    INTERACTION_LOG_QUEUE_SIZE,
+)
+
+# Seconds the writer thread waits for new records before flushing to disk
+FLUSH_INTERVAL = 1.0
+MAX_BATCH = 1000
+
+_STOP = object()
+
+class InteractionLogWriter:
+    """
+    Append-only JSONL sink for interaction records.
+
+    write() only enqueues; a background thread serializes, appends and
+    rotates the file by size or age, optionally gzipping rotated segments.
+    When the queue is full new records are dropped and counted.
+    """
+
+    def __init__(self, path: str = INTERACTION_LOG_PATH, max_bytes: int = INTERACTION_LOG_MAX_BYTES,
+                 rotate_interval: float = INTERACTION_LOG_ROTATE_INTERVAL,
+                 compress: bool = INTERACTION_LOG_COMPRESS, queue_size: int = INTERACTION_LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+    def start(self):
+        """Start the background writer thread"""
+        if self._thread is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='interaction-log', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Write everything still queued and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def write(self, record: dict):
+        """Queue a record for writing; the record must not be mutated afterwards"""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_stats(self) -> dict:
+        """Queue depth and write counters"""
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'rotations': self.rotations
+        }
+
+    def segments(self) -> List[str]:
+        """Rotated segments oldest first, followed by the active file"""
+        rotated = sorted(glob.glob(f"{glob.escape(self.path)}.*"))
+        if os.path.exists(self.path):
+            rotated.append(self.path)
+        return rotated
+
+    def iter_records(self) -> Iterator[dict]:
+        """Stream every record that has reached disk, oldest first"""
+        for segment in self.segments():
+            opener = gzip.open if segment.endswith('.gz') else open
+            with opener(segment, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def _run(self):
+        f = open(self.path, 'a', encoding='utf-8')
+        opened_at = time.monotonic()
+        running = True
+        while running:
+            try:
+                batch = [self._queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is _STOP:
+                    running = False
+                    continue
+                lines.append(json.dumps(record, separators=(',', ':')))
+
+            try:
+                if lines:
+                    f.write('\n'.join(lines) + '\n')
+                    f.flush()
+                    self.written += len(lines)
+
+                size = f.tell()
+                age = time.monotonic() - opened_at
+                if size and (size >= self.max_bytes or age >= self.rotate_interval):
+                    f.close()
+                    self._rotate()
+                    f = open(self.path, 'a', encoding='utf-8')
+                    opened_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error writing interaction log: {str(e)}", exc_info=True)
+        f.close()
+
+    def _rotate(self):
+        """Move the active file aside under a timestamped name"""
+        target = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.rename(self.path, target)
+
+        if self.compress:
+            with open(target, 'rb') as src, gzip.open(target + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(target)
+            target += '.gz'
+
+        self.rotations += 1
+        logger.info(f"Rotated interaction log to {target}")
@@ -0,0 +1,112 @@
+from typing import List, Optional, Sequence, Tuple
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from config import BUTTON_TABLE_SIZE, KEYBOARD_CACHE_SIZE
+
+# Telegram rejects callback_data longer than 64 bytes
+MAX_CALLBACK_BYTES = 64
+TEXT_PREFIX = 't:'
+ID_PREFIX = 'h:'
+
+class KeyboardBuilder:
+    """
+    Builds inline keyboards with compact callback data and memoizes them.
+
+    Labels that fit are sent inline as ``t:<label>`` so they survive restarts.
+    Longer labels are interned under a short content hash ``h:<id>`` backed by
+    a bounded LRU table; an id that fell out of the table resolves to None.
+    """
+
+    def __init__(self, max_buttons: int = BUTTON_TABLE_SIZE, max_keyboards: int = KEYBOARD_CACHE_SIZE):
+        self.max_buttons = max_buttons
+        self.max_keyboards = max_keyboards
+        self._texts: "OrderedDict[str, str]" = OrderedDict()
+        self._keyboards: "OrderedDict[Tuple[str, ...], Tuple[InlineKeyboardMarkup, List[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def callback_data(self, text: str) -> str:
+        """Callback payload for a button label, interning labels that are too long"""
+        data = TEXT_PREFIX + text
+        if len(data.encode('utf-8')) <= MAX_CALLBACK_BYTES:
+            return data
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=9).digest()
+        button_id = base64.urlsafe_b64encode(digest).decode('ascii')
+        self._texts[button_id] = text
+        self._texts.move_to_end(button_id)
+        if len(self._texts) > self.max_buttons:
+            self._texts.popitem(last=False)
+        return ID_PREFIX + button_id
+
+    def resolve(self, data: str) -> Optional[str]:
+        """Button label for callback data, or None when it can't be recovered"""
+        if data.startswith(TEXT_PREFIX):
+            return data[len(TEXT_PREFIX):]
+        if data.startswith(ID_PREFIX):
+            button_id = data[len(ID_PREFIX):]
+            text = self._texts.get(button_id)
+            if text is None:
+                self.expired += 1
+                return None
+            self._texts.move_to_end(button_id)
+            return text
+        if data.startswith('{'):
+            # Keyboards sent before callback ids were introduced
+            try:
+                return json.loads(data).get('text')
+            except ValueError:
+                return None
+        return None
+
+    def _is_current(self, ids: List[str], buttons: Sequence[str]) -> bool:
+        """Refresh a memoized keyboard's interned ids, reporting whether all are still known"""
+        for button_id, text in zip(ids, buttons):
+            if button_id is None:
+                continue
+            if self._texts.get(button_id) != text:
+                return False
+            self._texts.move_to_end(button_id)
+        return True
+
+    def build(self, buttons: Sequence[str]) -> InlineKeyboardMarkup:
+        """Inline keyboard with buttons in rows of 2, memoized by the button tuple"""
+        key = tuple(buttons)
+        cached = self._keyboards.get(key)
+        if cached is not None and self._is_current(cached[1], key):
+            self._keyboards.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+
+        self.misses += 1
+        keyboard = []
+        row = []
+        ids = []
+        for button in key:
+            data = self.callback_data(button)
+            ids.append(data[len(ID_PREFIX):] if data.startswith(ID_PREFIX) else None)
+            row.append(InlineKeyboardButton(button, callback_data=data))
+            if len(row) == 2:  # Create rows of 2 buttons
+                keyboard.append(row)
+                row = []
+        if row:  # Add any remaining buttons
+            keyboard.append(row)
+
+        markup = InlineKeyboardMarkup(keyboard)
+        self._keyboards[key] = (markup, ids)
+        if len(self._keyboards) > self.max_keyboards:
+            self._keyboards.popitem(last=False)
+        return markup
+
+    def get_stats(self) -> dict:
+        """Table sizes and keyboard cache hit/miss counters"""
+        return {
+            'interned_buttons': len(self._texts),
+            'keyboards': len(self._keyboards),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired
+        }
@@ -1,52 +1,340 @@
-import os
 import asyncio
-from datetime import datetime
-from threading import Thread
-from flask import Flask, jsonify
+import signal
+from contextlib import AsyncExitStack
+from functools import partial
+from typing import List, Optional
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.request import BaseRequest
 
 from telegram_handler import TelegramHandler
-from config import TELEGRAM_BOT_TOKEN
+from update_scheduler import UserOrderedUpdateProcessor
+from admission import AdmissionController
+from rate_limiter import PrioritizedRateLimiter
+from analytics import Analytics
+from interaction_log import InteractionLogWriter
+from media_cache import MediaCache
+from sharding import ShardDispatcher, shard_path
+from voiceflow_client import create_http_client
+import tenancy
+from tenancy import Tenant, SharedHTTPXRequest, load_tenants, create_handler, create_admission
+from webserver import WebServer
+from profiler import SamplingProfiler
+from metrics import (
+    REGISTRY,
+    PROMETHEUS_CONTENT_TYPE,
+    SESSIONS,
+    UPDATES_QUEUED,
+    LOOP_LAG,
+    VOICEFLOW_CIRCUIT_OPEN,
+    VOICEFLOW_CIRCUIT_TRIPS,
+    VOICEFLOW_TIMEOUT_SECONDS,
+    LoopLagMonitor,
+)
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_GLOBAL_RATE,
+    UPDATE_WORKERS,
+    UPDATE_MAX_PENDING,
+    INTERACTION_LOG_PATH,
+    MEDIA_CACHE_PATH,
+    WORKER_PROCESSES,
+    SHARD_STATS_INTERVAL,
+    TENANTS,
+    TELEGRAM_POOL_SIZE,
+    BOT_MODE,
+    PORT,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    DEBUG_TOKEN,
+    PROFILE_MAX_SECONDS,
+)
 from logger import logger
 
-app = Flask(__name__)
-telegram_handler = TelegramHandler()
-
-# Initialize bot application
-application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_message = "👋 Welcome! I'm your Voiceflow-powered assistant.\n/start - Start\n/clear - Reset\n/stats - Statistics"
     await update.message.reply_text(welcome_message)
 
-# Add handlers
-application.add_handler(CommandHandler("start", start_command))
-application.add_handler(CommandHandler("clear", telegram_handler.clear_session))
-application.add_handler(CommandHandler("stats", telegram_handler.get_analytics))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, telegram_handler.handle_message))
-application.add_handler(CallbackQueryHandler(telegram_handler.handle_callback_query))
-
-@app.route('/health')
-def health_check():
-    return jsonify({"status": "healthy"}), 200
-
-def run_bot():
-    """Run the bot in the background"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(application.initialize())
-    loop.run_until_complete(application.start())
-    loop.run_until_complete(application.updater.start_polling())
-    loop.run_forever()
+def build_application(telegram_handler: TelegramHandler, overall_rate: float = TELEGRAM_GLOBAL_RATE,
+                      updater: bool = True, token: str = TELEGRAM_BOT_TOKEN,
+                      admission: Optional[AdmissionController] = None,
+                      request: Optional[BaseRequest] = None) -> Application:
+    """Bot application with the update scheduler, rate limiter and handlers wired to ``telegram_handler``"""
+    admission = admission or AdmissionController(UPDATE_WORKERS)
+    update_processor = UserOrderedUpdateProcessor(
+        admission.max_in_flight,
+        UPDATE_MAX_PENDING,
+        telegram_handler.coalescer,
+        admission,
+        telegram_handler.reject_update
+    )
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(update_processor)
+        .rate_limiter(PrioritizedRateLimiter(overall_rate=overall_rate))
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Add handlers
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("clear", telegram_handler.clear_session))
+    application.add_handler(CommandHandler("stats", telegram_handler.get_analytics))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, telegram_handler.handle_message))
+    application.add_handler(CallbackQueryHandler(telegram_handler.handle_callback_query))
+    return application
+
+def register_gauges(application: Application, telegram_handler: TelegramHandler):
+    """Point the process's gauges at the live application state"""
+    SESSIONS.set_function(lambda: len(telegram_handler.session_manager))
+    UPDATES_QUEUED.set_function(lambda: application.update_processor.get_stats()['queued'])
+    breaker = telegram_handler.voiceflow_client.breaker
+    VOICEFLOW_CIRCUIT_OPEN.set_function(lambda: {'closed': 0, 'half_open': 0.5, 'open': 1}[breaker.state])
+    VOICEFLOW_CIRCUIT_TRIPS.set_function(lambda: breaker.trips)
+    VOICEFLOW_TIMEOUT_SECONDS.set_function(telegram_handler.voiceflow_client.timeout.current)
+
+def health_check(application: Application, telegram_handler: TelegramHandler) -> dict:
+    return {
+        "status": "healthy",
+        "mode": BOT_MODE,
+        "updates": application.update_processor.get_stats(),
+        "admission": application.update_processor.admission.get_stats(),
+        "sessions": telegram_handler.session_manager.get_stats(),
+        "voiceflow": telegram_handler.voiceflow_client.get_stats(),
+        "telegram": application.bot.rate_limiter.get_stats(),
+        "media_cache": telegram_handler.media_cache.get_stats(),
+        "keyboards": telegram_handler.keyboards.get_stats(),
+        "coalescing": telegram_handler.coalescer.get_stats()
+    }
+
+def create_web_server(application: Application, telegram_handler: TelegramHandler) -> WebServer:
+    """Build the HTTP server that shares the bot's event loop"""
+    server = WebServer(PORT)
+    server.add_json_route('/health', partial(health_check, application, telegram_handler))
+    server.add_json_route('/analytics', telegram_handler.analytics.get_global_metrics)
+    server.add_text_route('/metrics', REGISTRY.render, PROMETHEUS_CONTENT_TYPE)
+    if DEBUG_TOKEN:
+        server.add_debug_routes(DEBUG_TOKEN, telegram_handler.tracer.get_traces, SamplingProfiler(), PROFILE_MAX_SECONDS)
+    if BOT_MODE == 'webhook':
+        server.add_webhook(WEBHOOK_PATH, application, WEBHOOK_SECRET_TOKEN)
+    return server
+
+async def wait_for_shutdown():
+    """Block until SIGINT or SIGTERM is received"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+async def start_receiving(application: Application, webhook_path: str = WEBHOOK_PATH,
+                          secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN):
+    """Register the webhook or start long polling"""
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + webhook_path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Webhook registered with Telegram")
+        else:
+            logger.warning("WEBHOOK_URL not set, accepting updates only from local POSTs")
+    else:
+        await application.updater.start_polling()
+
+async def stop_receiving(application: Application):
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+
+async def run():
+    """Run the bot and the web server on a single event loop"""
+    telegram_handler = TelegramHandler()
+    application = build_application(telegram_handler)
+    register_gauges(application, telegram_handler)
+    loop_lag_monitor = LoopLagMonitor(LOOP_LAG)
+    server = create_web_server(application, telegram_handler)
+    async with application:
+        await application.start()
+        await telegram_handler.start()
+        loop_lag_monitor.start()
+        await start_receiving(application)
+        await server.start()
+        logger.info(f"Bot started in {BOT_MODE} mode")
+
+        try:
+            await wait_for_shutdown()
+        finally:
+            logger.info("Shutting down")
+            await server.stop()
+            await loop_lag_monitor.stop()
+            await stop_receiving(application)
+            await application.stop()
+            await telegram_handler.close()
+
+def run_worker(worker_id: int, updates, stats):
+    """Entry point of a worker process in sharded mode"""
+    # The front process coordinates shutdown through the update queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(worker_id, updates, stats))
+
+async def serve_shard(worker_id: int, updates, stats):
+    """Process the updates routed to this worker, reporting stats to the front"""
+    telegram_handler = TelegramHandler(
+        Analytics(InteractionLogWriter(path=shard_path(INTERACTION_LOG_PATH, worker_id))),
+        # Each worker saves its own cache file; sharing one path would interleave their writes
+        media_cache=MediaCache(path=shard_path(MEDIA_CACHE_PATH, worker_id) if MEDIA_CACHE_PATH else None)
+    )
+    # Telegram's global limit applies to the bot as a whole, so workers split it
+    application = build_application(telegram_handler, TELEGRAM_GLOBAL_RATE / WORKER_PROCESSES, updater=False)
+    register_gauges(application, telegram_handler)
+    loop_lag_monitor = LoopLagMonitor(LOOP_LAG)
+
+    def report():
+        stats.put({
+            'worker': worker_id,
+            'health': health_check(application, telegram_handler),
+            'analytics': telegram_handler.analytics.get_global_state(),
+            'metrics': REGISTRY.render()
+        })
+
+    async def report_periodically():
+        while True:
+            report()
+            await asyncio.sleep(SHARD_STATS_INTERVAL)
+
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        await telegram_handler.start()
+        loop_lag_monitor.start()
+        reporter = asyncio.create_task(report_periodically())
+        logger.info(f"Worker {worker_id} started")
+
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            reporter.cancel()
+            await loop_lag_monitor.stop()
+            await application.stop()
+            await telegram_handler.close()
+            report()
+            logger.info(f"Worker {worker_id} stopped")
+
+def sharded_health_check(dispatcher: ShardDispatcher) -> dict:
+    workers = dispatcher.get_stats()
+    return {
+        "status": "healthy" if all(worker['alive'] for worker in workers.values()) else "degraded",
+        "mode": BOT_MODE,
+        "workers": workers
+    }
+
+async def run_sharded():
+    """Receive updates in this process and hand them to worker processes by user"""
+    dispatcher = ShardDispatcher(WORKER_PROCESSES, run_worker)
+    dispatcher.start()
+
+    # The front only receives updates; handlers and per-user state live in the workers
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    server = WebServer(PORT)
+    server.add_json_route('/health', partial(sharded_health_check, dispatcher))
+    server.add_json_route('/analytics', dispatcher.get_global_metrics)
+    server.add_text_route('/metrics', dispatcher.render_metrics, PROMETHEUS_CONTENT_TYPE)
+    if BOT_MODE == 'webhook':
+        server.add_webhook(WEBHOOK_PATH, application, WEBHOOK_SECRET_TOKEN)
+
+    async with application:
+        forwarder = asyncio.create_task(dispatcher.run(application.update_queue))
+        await start_receiving(application)
+        await server.start()
+        logger.info(f"Bot started in {BOT_MODE} mode with {WORKER_PROCESSES} worker processes")
+
+        try:
+            await wait_for_shutdown()
+        finally:
+            logger.info("Shutting down")
+            await server.stop()
+            await stop_receiving(application)
+            forwarder.cancel()
+            while not application.update_queue.empty():
+                dispatcher.route(application.update_queue.get_nowait())
+            await asyncio.to_thread(dispatcher.stop)
+
+def tenants_health_check(tenants: List[Tenant]) -> dict:
+    return {
+        "status": "healthy",
+        "mode": BOT_MODE,
+        "tenants": {tenant.name: health_check(tenant.application, tenant.telegram_handler) for tenant in tenants}
+    }
+
+def create_tenants_web_server(tenants: List[Tenant]) -> WebServer:
+    """Web server for all tenants: one webhook path each, ops endpoints broken down by tenant"""
+    server = WebServer(PORT)
+    server.add_json_route('/health', partial(tenants_health_check, tenants))
+    server.add_json_route('/tenants', lambda: {tenant.name: tenant.get_stats() for tenant in tenants})
+    server.add_json_route('/analytics', partial(tenancy.get_global_metrics, tenants))
+    server.add_text_route('/metrics', partial(tenancy.render_metrics, tenants), PROMETHEUS_CONTENT_TYPE)
+    if DEBUG_TOKEN:
+        def traces():
+            return {tenant.name: tenant.telegram_handler.tracer.get_traces() for tenant in tenants}
+        server.add_debug_routes(DEBUG_TOKEN, traces, SamplingProfiler(), PROFILE_MAX_SECONDS)
+    if BOT_MODE == 'webhook':
+        for tenant in tenants:
+            server.add_webhook(tenant.webhook_path, tenant.application, tenant.config.webhook_secret_token)
+    return server
+
+async def run_tenants():
+    """Run every configured tenant's bot and one web server on a single event loop"""
+    if WORKER_PROCESSES > 1:
+        logger.warning("WORKER_PROCESSES is ignored when TENANTS is set, all tenants run in this process")
+    # Bot API URLs carry the token and the Voiceflow key is sent per request, so both pools are shared
+    telegram_request = SharedHTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+    voiceflow_http = create_http_client()
+    tenants = []
+    for config in load_tenants(TENANTS):
+        telegram_handler = create_handler(config, voiceflow_http)
+        # Telegram's flood limits are per bot, so each tenant keeps its own outbound limiter
+        application = build_application(telegram_handler, config.telegram_rate, token=config.telegram_bot_token,
+                                         admission=create_admission(config), request=telegram_request)
+        tenants.append(Tenant(config, telegram_handler, application))
+    loop_lag_monitor = LoopLagMonitor(LOOP_LAG)
+    server = create_tenants_web_server(tenants)
+
+    async with AsyncExitStack() as stack:
+        for tenant in tenants:
+            await stack.enter_async_context(tenant.application)
+            await tenant.application.start()
+            await tenant.telegram_handler.start()
+        loop_lag_monitor.start()
+        for tenant in tenants:
+            await start_receiving(tenant.application, tenant.webhook_path, tenant.config.webhook_secret_token)
+        await server.start()
+        logger.info(f"Bot started in {BOT_MODE} mode with {len(tenants)} tenants")
+
+        try:
+            await wait_for_shutdown()
+        finally:
+            logger.info("Shutting down")
+            await server.stop()
+            await loop_lag_monitor.stop()
+            for tenant in tenants:
+                await stop_receiving(tenant.application)
+            for tenant in tenants:
+                await tenant.application.stop()
+                await tenant.telegram_handler.close()
+            await voiceflow_http.aclose()
 
 if __name__ == "__main__":
-    # Start the bot in a separate thread
-    bot_thread = Thread(target=run_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
-    logger.info("Bot thread started")
-    
-    # Start Flask server
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    if TENANTS:
+        asyncio.run(run_tenants())
+    else:
+        asyncio.run(run() if WORKER_PROCESSES <= 1 else run_sharded())
@@ -0,0 +1,78 @@
+from typing import Optional
+import json
+import os
+from collections import OrderedDict
+from logger import logger
+from config import MEDIA_CACHE_SIZE, MEDIA_CACHE_PATH
+
+class MediaCache:
+    """
+    LRU map from image URL to the file_id Telegram assigned on first upload,
+    so later sends reuse the stored file instead of re-downloading the URL.
+    """
+
+    def __init__(self, capacity: int = MEDIA_CACHE_SIZE, path: Optional[str] = MEDIA_CACHE_PATH):
+        self.capacity = capacity
+        self.path = path
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def is_url(photo) -> bool:
+        return isinstance(photo, str) and photo.startswith(('http://', 'https://'))
+
+    def get(self, url: str) -> Optional[str]:
+        """Cached file_id for a URL, counting the lookup as a hit or miss"""
+        file_id = self._entries.get(url)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(url)
+        self.hits += 1
+        return file_id
+
+    def record(self, url: str, file_id: str):
+        self._entries[url] = file_id
+        self._entries.move_to_end(url)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, url: str):
+        """Forget a file_id Telegram no longer accepts"""
+        if self._entries.pop(url, None) is not None:
+            self.invalidated += 1
+
+    def load(self):
+        """Restore entries saved by a previous run"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for url, file_id in json.load(f)[-self.capacity:]:
+                    self._entries[url] = file_id
+            logger.info(f"Loaded {len(self._entries)} cached media ids from {self.path}")
+        except Exception as e:
+            logger.error(f"Error loading media cache: {str(e)}")
+
+    def save(self):
+        """Write entries to disk, least recently used first"""
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self._entries.items()), f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving media cache: {str(e)}")
+
+    def get_stats(self) -> dict:
+        """Cache size and hit/miss counters"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated
+        }
@@ -0,0 +1,256 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+import asyncio
+import time
+
+# Upper bounds in seconds; observations above the last bound land in an overflow bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0)
+
+class LatencyHistogram:
+    """Fixed-bucket histogram giving O(1) memory percentile estimates"""
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: 'LatencyHistogram'):
+        """Add another histogram with the same buckets into this one"""
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th quantile (0..1) by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if c and cumulative + c >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / c
+            cumulative += c
+        return self.bounds[-1]
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99)
+        }
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: List['_Metric'] = []
+
+    def register(self, metric: '_Metric'):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _add_label(sample: str, pair: str) -> str:
+    """Insert a label pair into one exposition sample line"""
+    brace, space = sample.find('{'), sample.find(' ')
+    if 0 <= brace < space:
+        return f"{sample[:brace + 1]}{pair},{sample[brace + 1:]}"
+    return f"{sample[:space]}{{{pair}}}{sample[space:]}"
+
+def merge_expositions(texts: Dict[str, str], label: str = 'worker') -> str:
+    """Combine exposition text rendered by several processes, labelling each sample with its source"""
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for source, text in texts.items():
+        pair = f'{label}="{_escape(source)}"'
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = line.split(' ', 3)[2]
+                family_headers = headers.setdefault(family, [])
+                if line not in family_headers:
+                    family_headers.append(line)
+                samples.setdefault(family, [])
+            elif line and family is not None:
+                samples[family].append(_add_label(line, pair))
+    lines = []
+    for family, family_headers in headers.items():
+        lines.extend(family_headers)
+        lines.extend(samples[family])
+    return '\n'.join(lines) + '\n'
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[tuple, object] = {}
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._series.items()
+        ]
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the (unlabelled) value from a callable at render time"""
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._series.items()
+        ]
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = buckets
+
+    def labels(self, **labels) -> LatencyHistogram:
+        key = self._key(labels)
+        histogram = self._series.get(key)
+        if histogram is None:
+            histogram = self._series[key] = LatencyHistogram(self.buckets)
+        return histogram
+
+    def observe(self, value: float, **labels):
+        self.labels(**labels).observe(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent inside the block, including awaits"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.labels(**labels).observe(time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, histogram in self._series.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [float('inf')], histogram.counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(histogram.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {histogram.count}")
+        return lines
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeping task"""
+
+    def __init__(self, histogram: Histogram, interval: float = 0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.histogram.observe(max(0.0, loop.time() - expected))
+
+# Hot-path instrumentation shared by the bot's modules
+STAGE_SECONDS = Histogram('bot_stage_duration_seconds', 'Time spent in each stage of a turn', ('stage',))
+ERRORS = Counter('bot_errors_total', 'Errors by component and exception type', ('component', 'type'))
+IN_FLIGHT = Gauge('bot_inflight_requests', 'Turns currently being processed')
+IN_FLIGHT.set(0)
+SESSIONS = Gauge('bot_sessions', 'Sessions resident in memory')
+UPDATES_QUEUED = Gauge('bot_updates_queued', 'Updates waiting for a worker or for the same user')
+VOICEFLOW_CIRCUIT_OPEN = Gauge('bot_voiceflow_circuit_open', 'Voiceflow circuit breaker state (0 closed, 0.5 half-open, 1 open)')
+VOICEFLOW_CIRCUIT_TRIPS = Gauge('bot_voiceflow_circuit_trips', 'Times the Voiceflow circuit breaker has opened')
+VOICEFLOW_TIMEOUT_SECONDS = Gauge('bot_voiceflow_timeout_seconds', 'Adaptive timeout applied to Voiceflow calls')
+LOOP_LAG = Histogram('bot_event_loop_lag_seconds', 'Delay between a scheduled and actual event loop wakeup',
+                     buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
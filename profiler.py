@@ -0,0 +1,95 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from config import PROFILE_INTERVAL
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the live process, aggregating stacks in folded
+    form (``thread;outer;...;inner``).
+
+    On the main thread of a Unix process it samples with a SIGPROF interval
+    timer, so the event loop is caught wherever it is burning CPU. Elsewhere
+    a background thread samples every thread's stack, which only sees the
+    loop where it releases the GIL, so hot pure-Python code is under-counted.
+    Time a turn spends awaiting I/O never appears under the turn itself.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.running = False
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _fold(self, frame, thread_name: str) -> str:
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame))
+            frame = frame.f_back
+        labels.append(thread_name)
+        return ';'.join(reversed(labels))
+
+    async def _sample_cpu(self, seconds: float, stacks: Counter):
+        thread_name = threading.current_thread().name
+
+        def on_sample(signum, frame):
+            if frame is not None:
+                stacks[self._fold(frame, thread_name)] += 1
+
+        previous = signal.signal(signal.SIGPROF, on_sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+
+    def _sample_threads(self, seconds: float, stacks: Counter):
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks[self._fold(frame, names.get(ident, str(ident)))] += 1
+            time.sleep(self.interval)
+
+    async def profile(self, seconds: float) -> dict:
+        """Sample for ``seconds`` while the event loop keeps running; one run at a time"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        stacks: Counter = Counter()
+        try:
+            if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+                mode = 'cpu'
+                await self._sample_cpu(seconds, stacks)
+            else:
+                mode = 'threads'
+                await asyncio.to_thread(self._sample_threads, seconds, stacks)
+        finally:
+            self.running = False
+
+        leaves: Counter = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return {
+            'mode': mode,
+            'seconds': seconds,
+            'interval': self.interval,
+            'samples': sum(stacks.values()),
+            'top_functions': [{'function': name, 'samples': count} for name, count in leaves.most_common(30)],
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in stacks.most_common()]
+        }
+
+def format_folded(result: dict) -> str:
+    """Profile as folded stack lines, the input format of flame graph tools"""
+    return ''.join(f"{entry['stack']} {entry['samples']}\n" for entry in result['stacks'])
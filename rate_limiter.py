@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from logger import logger
+from metrics import Counter
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE,
+    TELEGRAM_MAX_RETRIES,
+)
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Per-chat buckets kept before the least recently used are dropped
+MAX_TRACKED_CHATS = 10000
+
+TELEGRAM_RETRIES = Counter('bot_telegram_retries_total', 'Telegram requests retried after flood control')
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token and return 0, or return the seconds until one is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class PrioritizedRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Outbound limiter for the Bot API plugged into PTB's rate_limiter hook.
+
+    Every request takes a token from a global bucket; requests addressed to a
+    chat also take one from that chat's bucket (slower for groups). Waiters
+    for the global bucket are served by priority, so interactive replies
+    overtake bulk sends. ``RetryAfter`` responses pause the chat (or all
+    requests when no chat is involved) and the request is retried.
+
+    Pass ``rate_limit_args={'priority': PRIORITY_BULK}`` to deprioritize a send.
+    """
+
+    def __init__(self, overall_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, group_rate: float = TELEGRAM_GROUP_RATE,
+                 max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.overall_rate = overall_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global: Optional[TokenBucket] = None
+        self._chats: "OrderedDict[Union[int, str], TokenBucket]" = OrderedDict()
+        self._chat_hold: Dict[Union[int, str], float] = {}
+        self._global_hold = 0.0
+        self._waiters: List[tuple] = []
+        self._sequence = itertools.count()
+        self._turn = asyncio.Event()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        self._global = TokenBucket(self.overall_rate, self.overall_rate, asyncio.get_running_loop().time())
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Union[int, str], now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Negative ids and @usernames are groups or channels
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst, now)
+            if len(self._chats) > MAX_TRACKED_CHATS:
+                evicted, _ = self._chats.popitem(last=False)
+                self._chat_hold.pop(evicted, None)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire_chat(self, chat_id: Union[int, str]):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            hold = self._chat_hold.get(chat_id, 0.0) - now
+            delay = hold if hold > 0 else self._chat_bucket(chat_id, now).take(now)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _next_turn(self):
+        """Wake waiters so the new head of the queue can try the bucket"""
+        self._turn.set()
+        self._turn = asyncio.Event()
+
+    async def _acquire_global(self, priority: int):
+        if self._global is None:
+            await self.initialize()
+        loop = asyncio.get_running_loop()
+        entry = (priority, next(self._sequence))
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                if self._waiters[0] is entry:
+                    now = loop.time()
+                    hold = self._global_hold - now
+                    delay = hold if hold > 0 else self._global.take(now)
+                    if delay <= 0:
+                        return
+                    await asyncio.sleep(delay)
+                else:
+                    await self._turn.wait()
+        finally:
+            if self._waiters and self._waiters[0] is entry:
+                heapq.heappop(self._waiters)
+            else:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            self._next_turn()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        chat_id = data.get('chat_id')
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                TELEGRAM_RETRIES.inc()
+                until = asyncio.get_running_loop().time() + e.retry_after
+                if chat_id is not None:
+                    self._chat_hold[chat_id] = until
+                else:
+                    self._global_hold = until
+                logger.warning(f"Flood control on {endpoint} for chat {chat_id}, retrying in {e.retry_after}s")
+
+    def get_stats(self) -> dict:
+        """Send counters and current backlog"""
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'waiting': len(self._waiters),
+            'tracked_chats': len(self._chats)
+        }
@@ -0,0 +1,184 @@
+import itertools
+import random
+import time
+from collections import deque
+from typing import Optional
+from metrics import LatencyHistogram
+
+class CircuitBreaker:
+    """
+    Fails fast once at least ``failure_threshold`` calls have failed within
+    ``window`` seconds and failures make up at least ``failure_ratio`` of the
+    calls recorded in that window, so a handful of errors amid mostly
+    successful traffic doesn't trip it.
+
+    Once open, calls are refused for ``cooldown`` seconds, then a single probe
+    is let through (half-open): success closes the circuit, failure reopens it.
+    A probe whose outcome is never recorded stops blocking after another
+    ``cooldown``; callers that abandon a probe should ``release_probe()``.
+
+    ``allow()`` hands out a ticket that goes back with the call's outcome.
+    Only the probe's ticket can change the state from half-open; outcomes of
+    calls admitted before the circuit opened are ignored until it closes.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, window: float, cooldown: float, failure_ratio: float = 0.5):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.failure_ratio = failure_ratio
+        self.state = self.CLOSED
+        # [second, successes, failures] per second of the window, oldest first
+        self._buckets: deque = deque()
+        self._successes = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._tickets = itertools.count(1)
+        self._probe: Optional[int] = None
+        self._probe_started = 0.0
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self) -> Optional[int]:
+        """Ticket for a call that may go ahead now, None when it is refused"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.cooldown:
+                self.rejected += 1
+                return None
+            self.state = self.HALF_OPEN
+            self._probe = None
+        ticket = next(self._tickets)
+        if self.state == self.HALF_OPEN:
+            if self._probe is not None and now - self._probe_started < self.cooldown:
+                self.rejected += 1
+                return None
+            self._probe = ticket
+            self._probe_started = now
+        return ticket
+
+    def is_probe(self, ticket: Optional[int]) -> bool:
+        """Whether the call holding ``ticket`` is the half-open probe"""
+        return self.state == self.HALF_OPEN and ticket is not None and ticket == self._probe
+
+    def _expire(self, now: float):
+        while self._buckets and self._buckets[0][0] <= now - self.window - 1:
+            _, successes, failures = self._buckets.popleft()
+            self._successes -= successes
+            self._failures -= failures
+
+    def _count(self, now: float, failed: bool):
+        self._expire(now)
+        second = int(now)
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+        if failed:
+            self._buckets[-1][2] += 1
+            self._failures += 1
+        else:
+            self._buckets[-1][1] += 1
+            self._successes += 1
+
+    def _reset_window(self):
+        self._buckets.clear()
+        self._successes = 0
+        self._failures = 0
+
+    def record_success(self, ticket: Optional[int] = None):
+        if self.state == self.CLOSED:
+            self._count(time.monotonic(), False)
+        elif self.is_probe(ticket):
+            self.state = self.CLOSED
+            self._reset_window()
+            self._probe = None
+
+    def record_failure(self, ticket: Optional[int] = None):
+        now = time.monotonic()
+        if self.state == self.CLOSED:
+            self._count(now, True)
+            if (self._failures >= self.failure_threshold
+                    and self._failures >= self.failure_ratio * (self._successes + self._failures)):
+                self._open(now)
+        elif self.is_probe(ticket):
+            self._open(now)
+
+    def release_probe(self, ticket: Optional[int] = None):
+        """Give up a half-open probe whose outcome won't be recorded, so the next call probes"""
+        if self.is_probe(ticket):
+            self._probe = None
+
+    def _open(self, now: float):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._reset_window()
+        self._probe = None
+        self.trips += 1
+
+    def get_stats(self) -> dict:
+        """Current state and trip counters"""
+        self._expire(time.monotonic())
+        return {
+            'state': self.state,
+            'trips': self.trips,
+            'rejected': self.rejected,
+            'recent_failures': self._failures,
+            'recent_calls': self._successes + self._failures
+        }
+
+# Share of the timeout floor kept after each successful call
+FLOOR_DECAY = 0.99
+
+class AdaptiveTimeout:
+    """
+    Timeout derived from a high percentile of recent successful latencies.
+
+    Latencies go into two histograms that swap every ``window`` samples, so
+    the estimate follows the last one to two windows of traffic. Until
+    ``min_samples`` are seen the maximum is used. Calls that time out raise
+    a floor under the estimate, since they would otherwise never add the
+    slower latencies it needs to catch up.
+    """
+
+    def __init__(self, minimum: float, maximum: float, multiplier: float = 3.0,
+                 quantile: float = 0.99, window: int = 1000, min_samples: int = 50):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self._current = LatencyHistogram()
+        self._previous = LatencyHistogram()
+        # Raised by timeouts so a lasting slowdown can't keep every call timing out; 0 when unset
+        self._floor = 0.0
+
+    def observe(self, latency: float):
+        if self._current.count >= self.window:
+            self._previous, self._current = self._current, LatencyHistogram()
+        self._current.observe(latency)
+        if self._floor:
+            # Successes let the floor sink back, but not below what they needed
+            self._floor = max(latency * self.multiplier, self._floor * FLOOR_DECAY)
+            if self._floor <= self.minimum:
+                self._floor = 0.0
+
+    def observe_timeout(self, timeout: float):
+        """A call gave up after ``timeout`` seconds: double the timeout, up to the maximum"""
+        self._floor = min(self.maximum, max(self._floor, timeout) * 2)
+
+    def current(self) -> float:
+        """Timeout in seconds to use for the next call"""
+        combined = LatencyHistogram()
+        combined.merge(self._current)
+        combined.merge(self._previous)
+        if combined.count < self.min_samples:
+            return self.maximum
+        estimate = combined.percentile(self.quantile) * self.multiplier
+        return min(self.maximum, max(self.minimum, estimate, self._floor))
+
+def backoff_delay(attempt: int, base: float, cap: float = 5.0) -> float:
+    """Full-jitter exponential backoff for the given retry attempt (1-based)"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
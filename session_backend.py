@@ -0,0 +1,86 @@
+from typing import Dict, Optional
+import json
+import sqlite3
+import threading
+import time
+from logger import logger
+from config import SESSION_BACKEND, SESSION_DB_PATH
+
+def encode_record(record: dict) -> str:
+    """
+    Compact JSON for a session record. Done on the event loop before a
+    batch goes to a writer thread, which then never reads live session state.
+    """
+    return json.dumps(record, separators=(',', ':'))
+
+class SessionBackend:
+    """Interface for durable session storage"""
+
+    def load(self, user_id: str) -> Optional[dict]:
+        """Return the stored record for a user, if any"""
+        raise NotImplementedError
+
+    def save_many(self, records: Dict[str, Optional[str]]):
+        """Persist a batch of encoded records; a None record deletes the user's session"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the backend"""
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Session records stored as JSON in an SQLite database in WAL mode.
+
+    Loads use their own connection: WAL readers see the last committed
+    state without waiting for a batch write in progress on another thread.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at INTEGER NOT NULL)'
+        )
+        self._read_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        logger.info(f"Session database opened at {path}")
+
+    def load(self, user_id: str) -> Optional[dict]:
+        row = self._read_conn.execute(
+            'SELECT data FROM sessions WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, records: Dict[str, Optional[str]]):
+        now = int(time.time())
+        upserts = [(user_id, record, now) for user_id, record in records.items() if record is not None]
+        deletes = [(user_id,) for user_id, record in records.items() if record is None]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                if upserts:
+                    self._conn.executemany(
+                        'INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                        upserts
+                    )
+                if deletes:
+                    self._conn.executemany('DELETE FROM sessions WHERE user_id = ?', deletes)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        self._read_conn.close()
+        with self._lock:
+            self._conn.close()
+
+def create_session_backend(path: str = SESSION_DB_PATH) -> Optional[SessionBackend]:
+    """Build the backend selected by SESSION_BACKEND, None for memory only"""
+    if SESSION_BACKEND == 'sqlite':
+        return SQLiteSessionBackend(path)
+    return None
@@ -1,39 +1,195 @@
 from typing import Dict, Optional
-import json
-from datetime import datetime
+import asyncio
+import sys
+import time
+from collections import OrderedDict, deque
 from logger import logger
+from session_backend import SessionBackend, encode_record
+from config import SESSION_MAX_USERS, SESSION_IDLE_TTL, SESSION_HISTORY_SIZE, SESSION_FLUSH_INTERVAL
+
+# Number of sessions inspected when estimating memory per session
+MEMORY_SAMPLE_SIZE = 100
+
+class Session:
+    """Compact per-user session record"""
+    __slots__ = ('state', 'context', 'last_response', 'history', 'session_start', 'last_seen')
+
+    def __init__(self, history_size: int):
+        self.state: dict = {}
+        self.context: dict = {}
+        self.last_response = None
+        # Ring buffer of (epoch seconds, is_user, message) tuples
+        self.history: deque = deque(maxlen=history_size)
+        self.session_start = int(time.time())
+        self.last_seen = time.monotonic()
+
+    def to_record(self) -> dict:
+        """Serializable form used by session backends"""
+        return {
+            'state': self.state,
+            'context': self.context,
+            'last_response': self.last_response,
+            'history': list(self.history),
+            'session_start': self.session_start
+        }
+
+    @classmethod
+    def from_record(cls, record: dict, history_size: int) -> 'Session':
+        session = cls(history_size)
+        session.state = record.get('state') or {}
+        session.context = record.get('context') or {}
+        session.last_response = record.get('last_response')
+        session.history.extend(tuple(entry) for entry in record.get('history', []))
+        session.session_start = record.get('session_start', session.session_start)
+        return session
+
+    def memory_size(self) -> int:
+        """Approximate number of bytes held by this session"""
+        size = sys.getsizeof(self)
+        size += sys.getsizeof(self.state) + sys.getsizeof(self.context)
+        size += sum(sys.getsizeof(v) for v in self.context.values())
+        size += sys.getsizeof(self.history)
+        for entry in self.history:
+            size += sys.getsizeof(entry) + sys.getsizeof(entry[2])
+        return size
 
 class SessionManager:
-    def __init__(self):
-        self._sessions: Dict[str, dict] = {}
+    def __init__(self, max_sessions: int = SESSION_MAX_USERS, idle_ttl: float = SESSION_IDLE_TTL,
+                 history_size: int = SESSION_HISTORY_SIZE, backend: Optional[SessionBackend] = None,
+                 flush_interval: float = SESSION_FLUSH_INTERVAL):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.history_size = history_size
+        # Ordered from least to most recently used
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.evicted_capacity = 0
+        self.evicted_idle = 0
 
-    def get_session(self, user_id: str) -> dict:
-        """Get or create a session for a user"""
-        if user_id not in self._sessions:
-            self._sessions[user_id] = {
-                'state': {},
-                'context': {},
-                'last_response': None,
-                'conversation_history': [],
-                'session_start': datetime.now().isoformat()
+        # Write-behind state: sessions changed since the last flush, None marks a deletion.
+        # Evicted sessions stay referenced here until they have been written.
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._dirty: Dict[str, Optional[Session]] = {}
+        # The batch being written; still the newest state of its users until it commits
+        self._flushing: Dict[str, Optional[Session]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.loaded = 0
+        self.flushed = 0
+
+    async def start(self):
+        """Start the background flusher when a backend is configured"""
+        if self.backend is not None and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stop the flusher, write outstanding changes and close the backend"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self.backend is not None:
+            await self.flush()
+            self.backend.close()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing sessions: {str(e)}", exc_info=True)
+
+    async def flush(self):
+        """Write all dirty sessions to the backend in one transaction"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            pending, self._dirty = self._dirty, {}
+            self._flushing = pending
+            records = {
+                user_id: encode_record(session.to_record()) if session is not None else None
+                for user_id, session in pending.items()
             }
-        return self._sessions[user_id]
+            try:
+                await asyncio.to_thread(self.backend.save_many, records)
+            except Exception:
+                # Keep newer changes made while the write was in flight
+                for user_id, session in pending.items():
+                    self._dirty.setdefault(user_id, session)
+                raise
+            finally:
+                self._flushing = {}
+            self.flushed += len(records)
+            logger.debug(f"Flushed {len(records)} sessions")
+
+    def _mark_dirty(self, user_id: str, session: Optional[Session]):
+        if self.backend is not None:
+            self._dirty[user_id] = session
+
+    def _load(self, user_id: str) -> Optional[Session]:
+        """Find a session that is not resident in memory"""
+        if self.backend is None:
+            return None
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+        if user_id in self._flushing:
+            return self._flushing[user_id]
+        record = self.backend.load(user_id)
+        if record is None:
+            return None
+        self.loaded += 1
+        return Session.from_record(record, self.history_size)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expire_idle(self, now: float):
+        """Drop sessions idle for longer than the TTL, oldest first"""
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_seen <= self.idle_ttl:
+                break
+            del self._sessions[user_id]
+            self.evicted_idle += 1
+            logger.debug(f"Evicted idle session for user {user_id}")
+
+    def get_session(self, user_id: str) -> Session:
+        """Get or create a session for a user"""
+        now = time.monotonic()
+        self._expire_idle(now)
+
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id) or Session(self.history_size)
+            self._sessions[user_id] = session
+            if len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                self.evicted_capacity += 1
+                logger.debug(f"Evicted least recently used session for user {evicted_id}")
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_seen = now
+        return session
 
     def update_session(self, user_id: str, data: dict):
         """Update session data for a user"""
-        if user_id in self._sessions:
-            self._sessions[user_id].update(data)
-        else:
-            self._sessions[user_id] = data
+        session = self.get_session(user_id)
+        for key, value in data.items():
+            if key in Session.__slots__:
+                setattr(session, key, value)
+            else:
+                session.state[key] = value
+        self._mark_dirty(user_id, session)
 
     def add_to_history(self, user_id: str, message: str, is_user: bool = True):
         """Add a message to the conversation history"""
         session = self.get_session(user_id)
-        session['conversation_history'].append({
-            'message': message,
-            'is_user': is_user,
-            'timestamp': datetime.now().isoformat()
-        })
+        session.history.append((int(time.time()), is_user, message))
+        self._mark_dirty(user_id, session)
         logger.debug(f"Added message to history for user {user_id}")
 
     def clear_session(self, user_id: str):
@@ -41,14 +197,34 @@ class SessionManager:
         if user_id in self._sessions:
             logger.info(f"Clearing session for user {user_id}")
             del self._sessions[user_id]
+        self._mark_dirty(user_id, None)
 
     def get_context(self, user_id: str) -> dict:
         """Get the conversation context for a user"""
         session = self.get_session(user_id)
-        return session.get('context', {})
+        return session.context
 
     def set_context(self, user_id: str, context: dict):
         """Set the conversation context for a user"""
         session = self.get_session(user_id)
-        session['context'] = context
+        session.context = context
+        self._mark_dirty(user_id, session)
         logger.debug(f"Updated context for user {user_id}")
+
+    def get_stats(self) -> dict:
+        """Session counts, evictions and estimated memory per session"""
+        sample = []
+        for session in reversed(self._sessions.values()):
+            if len(sample) >= MEMORY_SAMPLE_SIZE:
+                break
+            sample.append(session.memory_size())
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'evicted_capacity': self.evicted_capacity,
+            'evicted_idle': self.evicted_idle,
+            'avg_session_bytes': sum(sample) // len(sample) if sample else 0,
+            'dirty': len(self._dirty),
+            'loaded': self.loaded,
+            'flushed': self.flushed
+        }
@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from bisect import bisect
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Union
+from telegram import Update
+from logger import logger
+from analytics import summarize_global_metrics
+from metrics import merge_expositions
+from update_scheduler import UserOrderedUpdateProcessor
+
+class HashRing:
+    """
+    Consistent hash ring placing ``replicas`` virtual points per node, so
+    resizing the ring only moves about 1/N of the keys to another node.
+    """
+
+    def __init__(self, nodes: Sequence[int], replicas: int = 100):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        self._points = sorted((self._hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def node_for(self, key: str, skip: Collection[int] = ()) -> int:
+        """Node owning a key: the first virtual point clockwise from its hash not on a ``skip`` node"""
+        index = bisect(self._hashes, self._hash(key))
+        for offset in range(len(self._points)):
+            node = self._points[(index + offset) % len(self._points)][1]
+            if node not in skip:
+                return node
+        raise LookupError("Every node is skipped")
+
+def shard_path(path: str, shard: Union[int, str]) -> str:
+    """Per-worker (or per-tenant) variant of a file path, e.g. logs/interactions-2.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{shard}{ext}"
+
+# Seconds between liveness checks of idle workers
+SUPERVISE_INTERVAL = 1.0
+# A worker dying within this many seconds of starting is crash-looping; restarts back off up to it
+MAX_RESTART_DELAY = 60.0
+
+class ShardDispatcher:
+    """
+    Front half of the sharded mode: routes each update to the worker process
+    owning its user, so per-user state stays local and updates stay ordered.
+
+    Workers run ``target(worker_id, updates, stats)``; they read update dicts
+    from ``updates`` until a None sentinel and periodically put a report
+    (``worker``, ``health``, ``analytics``, ``metrics``) on ``stats``.
+
+    A worker that dies is restarted on a fresh queue; updates it had queued
+    are lost. One that keeps dying right after starting is restarted with
+    exponential backoff, and until then its users go to the next live worker
+    on the ring.
+    """
+
+    def __init__(self, workers: int, target: Callable, replicas: int = 100):
+        # Workers start from a clean interpreter rather than a copy of the front
+        self._context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.ring = HashRing(range(workers), replicas)
+        self.stats_queue = self._context.Queue()
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes = [self._process(i) for i in range(workers)]
+        self.reports: Dict[int, dict] = {}
+        self.routed = [0] * workers
+        self.rerouted = 0
+        self.restarts = [0] * workers
+        self._started_at = [0.0] * workers
+        self._restart_delay = [0.0] * workers
+        self._down_since: Dict[int, float] = {}
+        self._stopping = False
+        self._collector = threading.Thread(target=self._collect, name='shard-stats', daemon=True)
+
+    def _process(self, shard: int) -> multiprocessing.Process:
+        return self._context.Process(
+            target=self.target, args=(shard, self.queues[shard], self.stats_queue), name=f"bot-worker-{shard}"
+        )
+
+    def start(self):
+        now = time.monotonic()
+        for i, process in enumerate(self.processes):
+            process.start()
+            self._started_at[i] = now
+        self._collector.start()
+        logger.info(f"Started {len(self.processes)} worker processes")
+
+    def _restart(self, shard: int):
+        # The dead worker may have been holding the queue's read lock, so its queue is abandoned
+        old = self.queues[shard]
+        old.cancel_join_thread()
+        old.close()
+        self.queues[shard] = self._context.Queue()
+        self.processes[shard] = self._process(shard)
+        self.processes[shard].start()
+        self._started_at[shard] = time.monotonic()
+        self.restarts[shard] += 1
+        del self._down_since[shard]
+        logger.warning(f"Restarted {self.processes[shard].name} (restart {self.restarts[shard]})")
+
+    def _check(self, shard: int) -> bool:
+        """Whether the worker can take updates, restarting it if it died and its backoff has passed"""
+        process = self.processes[shard]
+        if process.is_alive():
+            return True
+        if self._stopping:
+            return False
+        now = time.monotonic()
+        if shard not in self._down_since:
+            self._down_since[shard] = now
+            if now - self._started_at[shard] < MAX_RESTART_DELAY:
+                self._restart_delay[shard] = min(max(1.0, self._restart_delay[shard] * 2), MAX_RESTART_DELAY)
+            else:
+                self._restart_delay[shard] = 0.0
+            logger.error(f"{process.name} exited with code {process.exitcode}, updates queued for it are lost; "
+                         f"restarting in {self._restart_delay[shard]:g}s")
+        if now - self._down_since[shard] < self._restart_delay[shard]:
+            return False
+        self._restart(shard)
+        return True
+
+    def route(self, update: Update) -> Optional[int]:
+        """Send an update to its user's worker, returning the worker id (None if no worker is up)"""
+        key = UserOrderedUpdateProcessor.ordering_key(update) or str(update.update_id)
+        shard = self.ring.node_for(key)
+        if not self._check(shard):
+            down = {shard}
+            shard = None
+            while len(down) < len(self.processes):
+                candidate = self.ring.node_for(key, down)
+                if self._check(candidate):
+                    shard = candidate
+                    break
+                down.add(candidate)
+            if shard is None:
+                logger.error(f"No worker process is running, dropping update {update.update_id}")
+                return None
+            self.rerouted += 1
+        self.queues[shard].put(update.to_dict())
+        self.routed[shard] += 1
+        return shard
+
+    async def _supervise(self):
+        """Notice and restart dead workers even when no updates arrive"""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for shard in range(len(self.processes)):
+                self._check(shard)
+
+    async def run(self, update_queue: asyncio.Queue):
+        """Forward updates from the front's queue until cancelled"""
+        supervisor = asyncio.create_task(self._supervise())
+        try:
+            while True:
+                self.route(await update_queue.get())
+        finally:
+            supervisor.cancel()
+
+    def _collect(self):
+        while True:
+            report = self.stats_queue.get()
+            if report is None:
+                return
+            self.reports[report['worker']] = report
+
+    def stop(self, timeout: float = 30.0):
+        """Let workers finish their queued updates and exit; blocks"""
+        self._stopping = True
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit in time, terminating")
+                process.terminate()
+                process.join()
+        self.stats_queue.put(None)
+        self._collector.join()
+        logger.info("Worker processes stopped")
+
+    def _latest(self) -> List[dict]:
+        return [self.reports[worker] for worker in sorted(self.reports)]
+
+    def get_stats(self) -> dict:
+        """Liveness and routing counts per worker, with each worker's last health report"""
+        return {
+            str(i): {
+                'alive': process.is_alive(),
+                'routed': self.routed[i],
+                'restarts': self.restarts[i],
+                'health': self.reports.get(i, {}).get('health')
+            }
+            for i, process in enumerate(self.processes)
+        }
+
+    def get_global_metrics(self) -> dict:
+        """Usage metrics summed over the workers' latest reports"""
+        return summarize_global_metrics([report['analytics'] for report in self._latest()])
+
+    def render_metrics(self) -> str:
+        """Prometheus exposition of all workers, each sample labelled with its worker"""
+        return merge_expositions({str(report['worker']): report['metrics'] for report in self._latest()})
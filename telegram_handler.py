@@ -1,168 +1,454 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
-from voiceflow_client import VoiceflowClient
+from voiceflow_client import VoiceflowClient, ParsedResponse, ResponseBuilder
 from session_manager import SessionManager
+from session_backend import create_session_backend
 from analytics import Analytics
+from media_cache import MediaCache
+from keyboards import KeyboardBuilder
+from coalescer import MessageCoalescer
 from logger import logger
+from metrics import STAGE_SECONDS, ERRORS, IN_FLIGHT
+from rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_BULK
+from admission import SHED_RATE_LIMITED
+from tracing import Tracer, span
+from config import VOICEFLOW_STREAMING, STREAM_EDIT_INTERVAL
+import asyncio
+import dataclasses
 import time
-import json
+from contextlib import aclosing
 from datetime import datetime
+from typing import Optional
+
+# Telegram accepts 2-10 photos per album and at most 100 buttons per keyboard
+MEDIA_GROUP_SIZE = 10
+MAX_KEYBOARD_BUTTONS = 100
+
+BUSY_MESSAGE = "I'm handling a lot of conversations right now. Please try again in a moment."
+SLOW_DOWN_MESSAGE = "You're sending messages faster than I can answer. Please wait a moment."
 
 class TelegramHandler:
-    def __init__(self):
-        self.voiceflow_client = VoiceflowClient()
-        self.session_manager = SessionManager()
-        self.analytics = Analytics()
+    def __init__(self, analytics: Optional[Analytics] = None, voiceflow_client: Optional[VoiceflowClient] = None,
+                 session_manager: Optional[SessionManager] = None, media_cache: Optional[MediaCache] = None):
+        self.voiceflow_client = voiceflow_client or VoiceflowClient()
+        self.session_manager = session_manager or SessionManager(backend=create_session_backend())
+        self.analytics = analytics or Analytics()
+        self.media_cache = media_cache or MediaCache()
+        self.keyboards = KeyboardBuilder()
+        self.coalescer = MessageCoalescer()
+        self.tracer = Tracer()
+        self.streaming = VOICEFLOW_STREAMING
+        self.edit_interval = STREAM_EDIT_INTERVAL
+        if self.streaming and not self.voiceflow_client.project_id:
+            logger.warning("VOICEFLOW_STREAMING needs VOICEFLOW_PROJECT_ID, falling back to full responses")
+            self.streaming = False
+
+    async def start(self):
+        """Start background work owned by the handler"""
+        await self.session_manager.start()
+        self.analytics.start()
+        self.media_cache.load()
+
+    async def close(self):
+        """Flush state and release resources held by the handler"""
+        await self.session_manager.close()
+        self.media_cache.save()
+        await asyncio.to_thread(self.analytics.close)
+        await self.voiceflow_client.close()
+
+    async def _call_bot(self, stage: str, method, **kwargs):
+        """Call a Bot API method, timing it and counting failures"""
+        try:
+            with STAGE_SECONDS.time(stage=stage), span(stage):
+                return await method(**kwargs)
+        except Exception as e:
+            ERRORS.inc(component='telegram', type=type(e).__name__)
+            raise
+
+    async def send_message(self, context, **kwargs):
+        """Send a text message"""
+        return await self._call_bot('telegram_send_message', context.bot.send_message, **kwargs)
+
+    async def edit_message(self, context, **kwargs):
+        """Replace the text of a message sent earlier"""
+        return await self._call_bot('telegram_edit_message', context.bot.edit_message_text, **kwargs)
+
+    async def send_photo(self, context, photo, **kwargs):
+        """Send a photo, reusing Telegram's file_id when the URL was sent before"""
+        url = photo if self.media_cache.is_url(photo) else None
+        file_id = self.media_cache.get(url) if url else None
+        try:
+            message = await self._call_bot('telegram_send_photo', context.bot.send_photo, photo=file_id or photo, **kwargs)
+        except BadRequest:
+            if file_id is None:
+                raise
+            self.media_cache.invalidate(url)
+            file_id = None
+            message = await self._call_bot('telegram_send_photo', context.bot.send_photo, photo=url, **kwargs)
+        if url and file_id is None and message.photo:
+            self.media_cache.record(url, message.photo[-1].file_id)
+        return message
+
+    async def send_media_group(self, context, media: list, **kwargs):
+        """Send an album of photos, reusing cached file_ids for known URLs"""
+        urls = [item.media if self.media_cache.is_url(item.media) else None for item in media]
+        file_ids = [self.media_cache.get(url) if url else None for url in urls]
+        cached = [
+            InputMediaPhoto(file_id, caption=item.caption, parse_mode=item.parse_mode) if file_id else item
+            for item, file_id in zip(media, file_ids)
+        ]
+        try:
+            messages = await self._call_bot('telegram_send_media_group', context.bot.send_media_group, media=cached, **kwargs)
+        except BadRequest:
+            if not any(file_ids):
+                raise
+            for url, file_id in zip(urls, file_ids):
+                if file_id:
+                    self.media_cache.invalidate(url)
+            file_ids = [None] * len(media)
+            messages = await self._call_bot('telegram_send_media_group', context.bot.send_media_group, media=media, **kwargs)
+        for url, file_id, message in zip(urls, file_ids, messages):
+            if url and file_id is None and message.photo:
+                self.media_cache.record(url, message.photo[-1].file_id)
+        return messages
 
     def create_inline_keyboard(self, buttons):
         """Create Telegram inline keyboard from buttons"""
-        keyboard = []
-        row = []
-        for button in buttons:
-            callback_data = json.dumps({
-                "text": button,
-                "type": "button"
-            })
-            row.append(InlineKeyboardButton(button, callback_data=callback_data))
-            if len(row) == 2:  # Create rows of 2 buttons
-                keyboard.append(row)
+        return self.keyboards.build(buttons)
+
+    @staticmethod
+    def _button_names(item: dict) -> list:
+        """Carousel buttons arrive either as names or as Voiceflow button objects"""
+        return [
+            button.get('name') if isinstance(button, dict) else button
+            for button in item.get('buttons') or []
+        ]
+
+    @staticmethod
+    def _caption(item: dict) -> str:
+        """Markdown caption for a card"""
+        return f"*{item.get('title', '')}*\n{item.get('description', '')}"
+
+    @staticmethod
+    def _split_albums(items: list) -> list:
+        """Split photos into evenly sized albums of at most MEDIA_GROUP_SIZE, never leaving one alone"""
+        count = len(items)
+        albums = -(-count // MEDIA_GROUP_SIZE)
+        result = []
+        start = 0
+        for index in range(albums):
+            size = count // albums + (1 if index < count % albums else 0)
+            result.append(items[start:start + size])
+            start += size
+        return result
+
+    def _carousel_keyboards(self, carousel_data: list) -> list:
+        """Lay out every card's buttons as rows, split into keyboards Telegram accepts"""
+        names = [name for item in carousel_data for name in self._button_names(item)]
+        keyboards = []
+        rows = []
+        count = 0
+        for item in carousel_data:
+            buttons = self._button_names(item)
+            if not buttons:
+                continue
+            if rows and count + len(buttons) > MAX_KEYBOARD_BUTTONS:
+                keyboards.append(rows)
+                rows, count = [], 0
+            for offset in range(0, len(buttons), 2):
                 row = []
-        if row:  # Add any remaining buttons
-            keyboard.append(row)
-        return InlineKeyboardMarkup(keyboard)
+                for button in buttons[offset:offset + 2]:
+                    # Tell identical labels on different cards apart
+                    label = f"{item.get('title', '')} · {button}" if names.count(button) > 1 else button
+                    row.append(InlineKeyboardButton(label, callback_data=self.keyboards.callback_data(button)))
+                rows.append(row)
+            count += len(buttons)
+        if rows:
+            keyboards.append(rows)
+        return [InlineKeyboardMarkup(rows) for rows in keyboards]
 
     async def send_carousel(self, context, chat_id, carousel_data):
-        """Send a carousel as multiple cards with inline buttons"""
+        """
+        Send a carousel as photo albums followed by as few keyboard messages as possible.
+        Sends to one chat are order-dependent, so they go out one after another.
+        """
         try:
-            for item in carousel_data:
-                caption = f"*{item.get('title', '')}*\n{item.get('description', '')}"
-                buttons = item.get('buttons', [])
-                keyboard = self.create_inline_keyboard(buttons) if buttons else None
+            if len(carousel_data) == 1:
+                await self._send_card(context, chat_id, carousel_data[0])
+                return
 
-                if item.get('image'):
-                    await context.bot.send_photo(
+            images = [item for item in carousel_data if item.get('image')]
+            for index, album in enumerate(self._split_albums(images)):
+                # The first album answers the user, the rest can yield to other chats' replies
+                priority = {'priority': PRIORITY_INTERACTIVE if index == 0 else PRIORITY_BULK}
+                if len(album) == 1:
+                    await self.send_photo(
+                        context,
                         chat_id=chat_id,
-                        photo=item['image'],
-                        caption=caption,
+                        photo=album[0]['image'],
+                        caption=self._caption(album[0]),
                         parse_mode='Markdown',
-                        reply_markup=keyboard
+                        rate_limit_args=priority
                     )
                 else:
-                    await context.bot.send_message(
+                    await self.send_media_group(
+                        context,
                         chat_id=chat_id,
-                        text=caption,
-                        parse_mode='Markdown',
-                        reply_markup=keyboard
+                        media=[
+                            InputMediaPhoto(item['image'], caption=self._caption(item), parse_mode='Markdown')
+                            for item in album
+                        ],
+                        rate_limit_args=priority
                     )
+
+            # Cards without images are listed in the text of the keyboard message
+            text_cards = [self._caption(item) for item in carousel_data if not item.get('image')]
+            keyboards = self._carousel_keyboards(carousel_data)
+            if not keyboards and text_cards:
+                keyboards = [None]
+            for index, keyboard in enumerate(keyboards):
+                text = '\n\n'.join(text_cards) if index == 0 and text_cards else 'Choose an option:'
+                await self.send_message(
+                    context,
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode='Markdown',
+                    reply_markup=keyboard
+                )
         except Exception as e:
             logger.error(f"Error sending carousel: {str(e)}", exc_info=True)
             raise
 
+    async def _send_card(self, context, chat_id, card: dict):
+        """Send a single card as one message carrying its image, caption and buttons"""
+        buttons = self._button_names(card)
+        keyboard = self.create_inline_keyboard(buttons) if buttons else None
+
+        if card.get('image'):
+            await self.send_photo(
+                context,
+                chat_id=chat_id,
+                photo=card['image'],
+                caption=self._caption(card),
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+        else:
+            await self.send_message(
+                context,
+                chat_id=chat_id,
+                text=self._caption(card),
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callback queries"""
+        with self.tracer.trace('callback', str(update.callback_query.from_user.id)):
+            await self._handle_callback(update, context)
+
+    async def _handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        await query.answer()  # Acknowledge the button click
+        with span('telegram_answer_callback'):
+            await query.answer()  # Acknowledge the button click
 
+        IN_FLIGHT.inc()
         try:
-            data = json.loads(query.data)
+            start_time = time.time()
+            user_id = str(query.from_user.id)
+            button_text = self.keyboards.resolve(query.data)
+            if button_text is None:
+                await self.send_message(
+                    context,
+                    chat_id=query.message.chat_id,
+                    text="This button has expired. Please send your choice as a message."
+                )
+                return
+
             # Send the button's text as a message
             request = {
                 "request": {
                     "type": "text",
-                    "payload": data["text"]
+                    "payload": button_text
                 }
             }
 
-            # Get response from Voiceflow
-            response = self.voiceflow_client.interact(
-                str(query.from_user.id),
-                request,
-                self.session_manager.get_context(str(query.from_user.id))
-            )
-            await self.process_voiceflow_response(update, context, response, query.message.chat_id)
+            # Get response from Voiceflow and render it
+            parsed = await self._respond(update, context, user_id, request, query.message.chat_id)
+
+            with span('analytics'):
+                self.analytics.log_interaction(
+                    user_id=user_id,
+                    user_message=button_text,
+                    bot_response=parsed,
+                    latency=time.time() - start_time,
+                    button_click=True
+                )
 
         except Exception as e:
+            ERRORS.inc(component='handler', type=type(e).__name__)
             logger.error(f"Error handling callback query: {str(e)}", exc_info=True)
-            await context.bot.send_message(
+            await self.send_message(
+                context,
                 chat_id=query.message.chat_id,
                 text="Sorry, there was an error processing your selection. Please try again."
             )
+        finally:
+            IN_FLIGHT.dec()
+
+    async def _respond(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str, request: dict, chat_id) -> ParsedResponse:
+        """Run one Voiceflow turn with the user's session context and render the reply"""
+        if self.streaming:
+            return await self._stream_reply(update, context, user_id, request, chat_id)
+
+        response = await self.voiceflow_client.interact(user_id, request, self.session_manager.get_context(user_id))
+        # Parse once and share the result between rendering and analytics
+        parsed = self.voiceflow_client.process_response(response)
+        with span('render'):
+            await self.process_voiceflow_response(update, context, parsed, chat_id)
+        return parsed
+
+    async def _stream_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str, request: dict, chat_id) -> ParsedResponse:
+        """
+        Render a streamed reply: the first text goes out as soon as it arrives,
+        then the message is edited at most once per ``edit_interval`` as it grows.
+        The last edit adds formatting and buttons; images, cards and carousels
+        follow once the stream ends.
+        """
+        started = time.perf_counter()
+        builder = ResponseBuilder()
+        message = None
+        sent_text = None
+        last_edit = 0.0
+
+        traces = self.voiceflow_client.interact_stream(user_id, request, self.session_manager.get_context(user_id))
+        async with aclosing(traces):
+            async for trace in traces:
+                if not builder.feed(trace):
+                    continue
+                text = builder.text
+                if not text.strip():
+                    continue
+                if message is None:
+                    message = await self.send_message(context, chat_id=chat_id, text=text)
+                    STAGE_SECONDS.observe(time.perf_counter() - started, stage='first_text')
+                elif text != sent_text and time.monotonic() - last_edit >= self.edit_interval:
+                    # Progress edits may wait behind other chats' replies
+                    await self.edit_message(
+                        context,
+                        chat_id=chat_id,
+                        message_id=message.message_id,
+                        text=text,
+                        rate_limit_args={'priority': PRIORITY_BULK}
+                    )
+                else:
+                    continue
+                sent_text = text
+                last_edit = time.monotonic()
+
+        parsed = builder.result()
+        if message is None:
+            await self.process_voiceflow_response(update, context, parsed, chat_id)
+            return parsed
 
-    async def process_voiceflow_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE, response, chat_id):
-        """Process different types of Voiceflow responses"""
         try:
-            processed_response = self.voiceflow_client.process_response(response)
+            await self.edit_message(
+                context,
+                chat_id=chat_id,
+                message_id=message.message_id,
+                text=parsed.text,
+                reply_markup=self.create_inline_keyboard(parsed.buttons) if parsed.buttons else None,
+                parse_mode='Markdown'
+            )
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        await self.process_voiceflow_response(update, context, dataclasses.replace(parsed, text=None, buttons=[]), chat_id)
+        return parsed
 
+    async def process_voiceflow_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE, processed_response: ParsedResponse, chat_id):
+        """Process different types of Voiceflow responses"""
+        try:
             # Update session context
-            if processed_response.get('context'):
-                self.session_manager.set_context(str(update.effective_user.id), processed_response['context'])
+            if processed_response.context:
+                self.session_manager.set_context(str(update.effective_user.id), processed_response.context)
 
             # Handle carousel type
-            if processed_response.get('carousel'):
-                await self.send_carousel(context, chat_id, processed_response['carousel'])
+            if processed_response.carousel:
+                await self.send_carousel(context, chat_id, processed_response.carousel)
                 return
 
             # Handle card type
-            if processed_response.get('card'):
-                card = processed_response['card']
-                caption = f"*{card.get('title', '')}*\n{card.get('description', '')}"
-                keyboard = self.create_inline_keyboard(card.get('buttons', [])) if card.get('buttons') else None
-
-                if card.get('image'):
-                    await context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=card['image'],
-                        caption=caption,
-                        parse_mode='Markdown',
-                        reply_markup=keyboard
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=caption,
-                        parse_mode='Markdown',
-                        reply_markup=keyboard
-                    )
+            if processed_response.card:
+                await self._send_card(context, chat_id, processed_response.card)
                 return
 
             # Send image if present
-            if processed_response['image_url']:
-                await context.bot.send_photo(
+            if processed_response.image_url:
+                await self.send_photo(
+                    context,
                     chat_id=chat_id,
-                    photo=processed_response['image_url']
+                    photo=processed_response.image_url
                 )
 
             # Send text with buttons if present
-            if processed_response['text']:
-                keyboard = self.create_inline_keyboard(processed_response['buttons']) if processed_response['buttons'] else None
-                await context.bot.send_message(
+            if processed_response.text:
+                keyboard = self.create_inline_keyboard(processed_response.buttons) if processed_response.buttons else None
+                await self.send_message(
+                    context,
                     chat_id=chat_id,
-                    text=processed_response['text'],
+                    text=processed_response.text,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
                 )
 
         except Exception as e:
+            ERRORS.inc(component='handler', type=type(e).__name__)
             logger.error(f"Error processing Voiceflow response: {str(e)}", exc_info=True)
-            await context.bot.send_message(
+            await self.send_message(
+                context,
                 chat_id=chat_id,
                 text="I encountered an error processing the response. Please try again."
             )
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming messages from Telegram"""
+        if not self.coalescer.enabled:
+            await self._handle_turn(update, context, update.message.text)
+            return
+
+        user_id = str(update.effective_user.id)
+        chat_id = update.effective_chat.id
+        try:
+            if not self.coalescer.is_open(user_id, chat_id):
+                # Not debounced by the update scheduler: let rapid follow-ups join this turn here
+                self.coalescer.open(user_id, chat_id, update.message.text)
+                await asyncio.sleep(self.coalescer.window)
+            while True:
+                message_text = self.coalescer.drain(user_id, chat_id)
+                if message_text is None:
+                    break
+                await self._handle_turn(update, context, message_text)
+        finally:
+            self.coalescer.close(user_id, chat_id)
+
+    async def _handle_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+        """Send one (possibly merged) user message to Voiceflow and render the reply"""
+        with self.tracer.trace('message', str(update.effective_user.id)):
+            await self._run_turn(update, context, message_text)
+
+    async def _run_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+        IN_FLIGHT.inc()
         try:
             start_time = time.time()
             user_id = str(update.effective_user.id)
-            message_text = update.message.text
 
             logger.info(f"Received message from user {user_id}: {message_text[:50]}...")
 
             # Add user message to history
-            self.session_manager.add_to_history(user_id, message_text)
-
-            # Get current session context
-            session_context = self.session_manager.get_context(user_id)
+            with span('session'):
+                self.session_manager.add_to_history(user_id, message_text)
 
             # Prepare request for Voiceflow
             request = {
@@ -172,34 +458,50 @@ class TelegramHandler:
                 }
             }
 
-            # Get response from Voiceflow with context
-            response = self.voiceflow_client.interact(user_id, request, session_context)
-            
-            # Process and send response
-            await self.process_voiceflow_response(update, context, response, update.effective_chat.id)
+            # Get response from Voiceflow with context and render it
+            parsed = await self._respond(update, context, user_id, request, update.effective_chat.id)
 
             # Calculate and log analytics
             latency = time.time() - start_time
-            self.analytics.log_interaction(
-                user_id=user_id,
-                user_message=message_text,
-                bot_response=self.voiceflow_client.process_response(response),
-                latency=latency
-            )
+            with span('analytics'):
+                self.analytics.log_interaction(
+                    user_id=user_id,
+                    user_message=message_text,
+                    bot_response=parsed,
+                    latency=latency
+                )
 
         except Exception as e:
+            ERRORS.inc(component='handler', type=type(e).__name__)
             logger.error(f"Error handling message: {str(e)}", exc_info=True)
-            await context.bot.send_message(
+            await self.send_message(
+                context,
                 chat_id=update.effective_chat.id,
                 text="I'm sorry, but I encountered an error. Please try again later."
             )
+        finally:
+            IN_FLIGHT.dec()
+
+    async def reject_update(self, update: Update, reason: str):
+        """Cheap reply for an update shed by admission control; Voiceflow is never called"""
+        text = SLOW_DOWN_MESSAGE if reason == SHED_RATE_LIMITED else BUSY_MESSAGE
+        if update.callback_query:
+            await self._call_bot('telegram_answer_callback', update.callback_query.answer, text=text)
+        elif update.effective_chat:
+            await self._call_bot(
+                'telegram_send_message',
+                update.get_bot().send_message,
+                chat_id=update.effective_chat.id,
+                text=text
+            )
 
     async def clear_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Clear user session data"""
         user_id = str(update.effective_user.id)
         self.session_manager.clear_session(user_id)
         logger.info(f"Cleared session for user {user_id}")
-        await context.bot.send_message(
+        await self.send_message(
+            context,
             chat_id=update.effective_chat.id,
             text="Your session has been reset."
         )
@@ -210,18 +512,21 @@ class TelegramHandler:
         metrics = self.analytics.get_user_metrics(user_id)
         
         if metrics:
+            latency = self.analytics.get_user_latency(user_id)
             message = (
                 f"Your Chat Statistics:\n"
                 f"Total messages: {metrics['total_messages']}\n"
                 f"Button clicks: {metrics['button_clicks']}\n"
                 f"Images received: {metrics['images_received']}\n"
+                f"Response time (p50/p95): {latency['p50']:.2f}s / {latency['p95']:.2f}s\n"
                 f"First interaction: {metrics['first_interaction']}\n"
                 f"Last interaction: {metrics['last_interaction']}"
             )
         else:
             message = "No analytics data available for your account yet."
         
-        await context.bot.send_message(
+        await self.send_message(
+            context,
             chat_id=update.effective_chat.id,
             text=message
         )
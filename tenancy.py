@@ -0,0 +1,196 @@
+"""
+Several bot/Voiceflow project pairs served by one process.
+
+Each tenant has its own TelegramHandler (sessions, analytics, media cache,
+Voiceflow circuit breaker), update scheduler limits and outbound rate
+limiter, since Telegram's flood limits apply per bot token. The Bot API and
+Voiceflow HTTP connection pools are shared by all tenants.
+"""
+import json
+import re
+from dataclasses import dataclass, fields
+from typing import List, Optional, Sequence
+import httpx
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+from telegram_handler import TelegramHandler
+from voiceflow_client import VoiceflowClient
+from session_manager import SessionManager
+from session_backend import create_session_backend
+from analytics import Analytics, summarize_global_metrics
+from interaction_log import InteractionLogWriter
+from media_cache import MediaCache
+from admission import AdmissionController
+from sharding import shard_path
+from metrics import REGISTRY, Registry, Gauge, merge_expositions
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    UPDATE_WORKERS,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_USER_RATE,
+    ADMISSION_USER_BURST,
+    INTERACTION_LOG_PATH,
+    SESSION_DB_PATH,
+    MEDIA_CACHE_PATH,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+)
+
+# Names end up in URLs, file names and metric labels
+TENANT_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+@dataclass(slots=True)
+class TenantConfig:
+    """One entry of TENANTS; limits not given fall back to the process-wide settings"""
+    name: str
+    telegram_bot_token: str
+    voiceflow_api_key: str
+    voiceflow_project_id: Optional[str] = None
+    webhook_secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN
+    telegram_rate: float = TELEGRAM_GLOBAL_RATE
+    update_workers: int = UPDATE_WORKERS
+    admission_max_queue: int = ADMISSION_MAX_QUEUE
+    admission_user_rate: float = ADMISSION_USER_RATE
+    admission_user_burst: float = ADMISSION_USER_BURST
+
+def load_tenants(spec: str) -> List[TenantConfig]:
+    """Parse TENANTS, either inline JSON or the path of a JSON file, into tenant configs"""
+    if not spec.lstrip().startswith('['):
+        with open(spec) as f:
+            spec = f.read()
+    entries = json.loads(spec)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("TENANTS must be a non-empty JSON list")
+
+    known = {field.name for field in fields(TenantConfig)}
+    tenants = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Tenant {i} must be a JSON object")
+        unknown = set(entry) - known
+        if unknown:
+            raise ValueError(f"Tenant {i} has unknown keys: {', '.join(sorted(unknown))}")
+        try:
+            tenant = TenantConfig(**entry)
+        except TypeError as e:
+            raise ValueError(f"Tenant {i} is incomplete: {e}")
+        if not TENANT_NAME.match(str(tenant.name)):
+            raise ValueError(f"Tenant {i} name must be 1-64 letters, digits, '-' or '_'")
+        tenants.append(tenant)
+
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("Tenant names must be unique")
+    if len({tenant.telegram_bot_token for tenant in tenants}) != len(tenants):
+        raise ValueError("Each tenant needs its own Telegram bot token")
+    return tenants
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """
+    Bot API request object shared by several bots. Bot API URLs carry the
+    token, so one connection pool can serve every tenant; it is closed when
+    the last bot using it shuts down.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._users = 0
+
+    async def initialize(self) -> None:
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self) -> None:
+        self._users -= 1
+        if self._users <= 0:
+            await super().shutdown()
+
+def create_handler(config: TenantConfig, voiceflow_http: httpx.AsyncClient) -> TelegramHandler:
+    """Handler with the tenant's own state files, calling Voiceflow through the shared pool"""
+    return TelegramHandler(
+        Analytics(InteractionLogWriter(path=shard_path(INTERACTION_LOG_PATH, config.name))),
+        VoiceflowClient(config.voiceflow_api_key, config.voiceflow_project_id, voiceflow_http),
+        SessionManager(backend=create_session_backend(shard_path(SESSION_DB_PATH, config.name))),
+        # file_ids are only valid for the bot that uploaded the file
+        MediaCache(path=shard_path(MEDIA_CACHE_PATH, config.name) if MEDIA_CACHE_PATH else None)
+    )
+
+def create_admission(config: TenantConfig) -> AdmissionController:
+    return AdmissionController(
+        config.update_workers,
+        config.admission_max_queue,
+        config.admission_user_rate,
+        config.admission_user_burst
+    )
+
+class Tenant:
+    """A running tenant: its config, handler, application and metrics"""
+
+    def __init__(self, config: TenantConfig, telegram_handler: TelegramHandler, application: Application):
+        self.config = config
+        self.name = config.name
+        self.telegram_handler = telegram_handler
+        self.application = application
+        self.webhook_path = f"{WEBHOOK_PATH.rstrip('/')}/{config.name}"
+        self.registry = Registry()
+        self._register_gauges()
+
+    def _register_gauges(self):
+        handler, application = self.telegram_handler, self.application
+        admission = application.update_processor.admission
+        breaker = handler.voiceflow_client.breaker
+        gauges = (
+            ('bot_tenant_sessions', 'Sessions resident in memory', lambda: len(handler.session_manager)),
+            ('bot_tenant_updates_queued', 'Updates waiting for a worker or for the same user',
+             lambda: application.update_processor.get_stats()['queued']),
+            ('bot_tenant_updates_in_flight', 'Updates running a handler', lambda: admission.get_stats()['in_flight']),
+            ('bot_tenant_updates_max_in_flight', 'Limit on updates running a handler', lambda: admission.max_in_flight),
+            ('bot_tenant_updates_accepted', 'Updates admitted since start', lambda: admission.accepted),
+            ('bot_tenant_updates_shed', 'Updates shed by admission control since start',
+             lambda: sum(admission.shed.values())),
+            ('bot_tenant_user_rate', 'Limit on turns per second per user', lambda: admission.user_rate),
+            ('bot_tenant_turns', 'Turns logged since start', lambda: handler.analytics.totals['total_messages']),
+            ('bot_tenant_telegram_sent', 'Bot API requests sent since start',
+             lambda: application.bot.rate_limiter.get_stats()['sent']),
+            ('bot_tenant_telegram_rate', 'Limit on Bot API requests per second',
+             lambda: application.bot.rate_limiter.overall_rate),
+            ('bot_tenant_voiceflow_circuit_open', 'Voiceflow circuit breaker state (0 closed, 0.5 half-open, 1 open)',
+             lambda: {'closed': 0, 'half_open': 0.5, 'open': 1}[breaker.state]),
+        )
+        for name, help, function in gauges:
+            Gauge(name, help, registry=self.registry).set_function(function)
+
+    def get_stats(self) -> dict:
+        """Limits and current usage"""
+        admission = self.application.update_processor.admission.get_stats()
+        return {
+            'voiceflow_project_id': self.config.voiceflow_project_id,
+            'webhook_path': self.webhook_path,
+            'limits': {
+                'telegram_rate': self.config.telegram_rate,
+                'update_workers': self.config.update_workers,
+                'admission_max_queue': self.config.admission_max_queue,
+                'admission_user_rate': self.config.admission_user_rate,
+                'admission_user_burst': self.config.admission_user_burst
+            },
+            'usage': {
+                'in_flight': admission['in_flight'],
+                'queued': admission['queued'],
+                'accepted': admission['accepted'],
+                'shed': admission['shed'],
+                'sessions': len(self.telegram_handler.session_manager),
+                'turns': self.telegram_handler.analytics.totals['total_messages']
+            }
+        }
+
+def get_global_metrics(tenants: Sequence[Tenant]) -> dict:
+    """Analytics summed over all tenants, and per tenant"""
+    return {
+        'total': summarize_global_metrics([tenant.telegram_handler.analytics.get_global_state() for tenant in tenants]),
+        'tenants': {tenant.name: tenant.telegram_handler.analytics.get_global_metrics() for tenant in tenants}
+    }
+
+def render_metrics(tenants: Sequence[Tenant]) -> str:
+    """Process-wide metrics followed by every tenant's, each sample labelled with its tenant"""
+    return REGISTRY.render() + merge_expositions({tenant.name: tenant.registry.render() for tenant in tenants},
+                                                 label='tenant')
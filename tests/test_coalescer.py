@@ -0,0 +1,32 @@
+import unittest
+from coalescer import MessageCoalescer
+
+class MessageCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = MessageCoalescer(window=0.5, max_messages=3)
+
+    def test_merges_messages_in_the_same_chat(self):
+        self.coalescer.open('1', 10, 'hello')
+        self.assertTrue(self.coalescer.absorb('1', 10, 'there'))
+        self.assertEqual(self.coalescer.drain('1', 10), 'hello\nthere')
+        self.assertIsNone(self.coalescer.drain('1', 10))
+
+    def test_refuses_text_from_another_chat(self):
+        self.coalescer.open('1', 10, 'private')
+        self.assertFalse(self.coalescer.absorb('1', -20, 'group'))
+        self.assertFalse(self.coalescer.is_open('1', -20))
+        self.assertEqual(self.coalescer.drain('1', 10), 'private')
+
+    def test_full_buffer_refuses(self):
+        self.coalescer.open('1', 10, 'a')
+        self.assertTrue(self.coalescer.absorb('1', 10, 'b'))
+        self.assertTrue(self.coalescer.absorb('1', 10, 'c'))
+        self.assertFalse(self.coalescer.absorb('1', 10, 'd'))
+
+    def test_close(self):
+        self.coalescer.open('1', 10, 'a')
+        self.coalescer.close('1', 10)
+        self.assertFalse(self.coalescer.absorb('1', 10, 'b'))
+
+if __name__ == '__main__':
+    unittest.main()
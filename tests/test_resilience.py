@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+from resilience import AdaptiveTimeout, CircuitBreaker
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('resilience.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, window=10, cooldown=5)
+
+    def trip(self):
+        tickets = [self.breaker.allow() for _ in range(3)]
+        for ticket in tickets:
+            self.breaker.record_failure(ticket)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_closed_open_half_open_closed(self):
+        self.trip()
+        self.assertIsNone(self.breaker.allow())
+
+        self.clock.now += 5
+        probe = self.breaker.allow()
+        self.assertIsNotNone(probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.is_probe(probe))
+        self.assertIsNone(self.breaker.allow())
+
+        self.breaker.record_success(probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertIsNotNone(self.breaker.allow())
+        self.assertEqual(self.breaker.trips, 1)
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.clock.now += 5
+        probe = self.breaker.allow()
+        self.breaker.record_failure(probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.trips, 2)
+        self.assertIsNone(self.breaker.allow())
+
+    def test_ratio_keeps_circuit_closed(self):
+        for _ in range(10):
+            self.breaker.record_success(self.breaker.allow())
+        for _ in range(3):
+            self.breaker.record_failure(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_late_success_while_open_is_ignored(self):
+        late = self.breaker.allow()
+        self.trip()
+        self.breaker.record_success(late)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_late_failures_while_open_do_not_retrip(self):
+        late = [self.breaker.allow() for _ in range(20)]
+        self.trip()
+        for ticket in late:
+            self.breaker.record_failure(ticket)
+        self.assertEqual(self.breaker.trips, 1)
+        self.clock.now += 5
+        self.assertIsNotNone(self.breaker.allow())
+
+    def test_late_outcomes_while_half_open_are_ignored(self):
+        late = [self.breaker.allow() for _ in range(2)]
+        self.trip()
+        self.clock.now += 5
+        probe = self.breaker.allow()
+
+        self.breaker.record_success(late[0])
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.record_failure(late[1])
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.release_probe(late[0])
+        self.assertIsNone(self.breaker.allow())
+
+        self.breaker.record_success(probe)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_released_probe_lets_next_call_probe(self):
+        self.trip()
+        self.clock.now += 5
+        probe = self.breaker.allow()
+        self.breaker.release_probe(probe)
+        second = self.breaker.allow()
+        self.assertIsNotNone(second)
+        self.assertTrue(self.breaker.is_probe(second))
+        self.assertFalse(self.breaker.is_probe(probe))
+
+    def test_stranded_probe_expires(self):
+        self.trip()
+        self.clock.now += 5
+        self.assertIsNotNone(self.breaker.allow())
+        self.clock.now += 4
+        self.assertIsNone(self.breaker.allow())
+        self.clock.now += 1
+        self.assertIsNotNone(self.breaker.allow())
+
+class AdaptiveTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.timeout = AdaptiveTimeout(minimum=0.5, maximum=30, multiplier=3, min_samples=10)
+        for _ in range(100):
+            self.timeout.observe(0.2)
+
+    def test_follows_latency(self):
+        self.assertLess(self.timeout.current(), 1.0)
+
+    def test_timeouts_widen_up_to_maximum(self):
+        before = self.timeout.current()
+        self.timeout.observe_timeout(before)
+        self.assertGreater(self.timeout.current(), before)
+        for _ in range(10):
+            self.timeout.observe_timeout(self.timeout.current())
+        self.assertEqual(self.timeout.current(), 30)
+
+    def test_slow_successes_hold_the_widened_timeout(self):
+        for _ in range(10):
+            self.timeout.observe_timeout(self.timeout.current())
+        for _ in range(50):
+            self.timeout.observe(8.0)
+        self.assertGreaterEqual(self.timeout.current(), 24)
+
+    def test_fast_successes_shrink_it_again(self):
+        self.timeout.observe_timeout(self.timeout.current())
+        for _ in range(1000):
+            self.timeout.observe(0.2)
+        self.assertLess(self.timeout.current(), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
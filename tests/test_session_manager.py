@@ -0,0 +1,47 @@
+import asyncio
+import json
+import threading
+import unittest
+from session_backend import SessionBackend
+from session_manager import SessionManager
+
+class BlockingBackend(SessionBackend):
+    """Holds each batch write until released, so the loop can run meanwhile"""
+
+    def __init__(self):
+        self.saved = {}
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def load(self, user_id):
+        record = self.saved.get(user_id)
+        return json.loads(record) if record else None
+
+    def save_many(self, records):
+        self.started.set()
+        self.release.wait(5)
+        self.saved.update(records)
+
+class SessionFlushTest(unittest.TestCase):
+    def test_flush_writes_the_state_as_of_the_flush(self):
+        async def run():
+            backend = BlockingBackend()
+            manager = SessionManager(backend=backend)
+            session = manager.get_session('1')
+            session.context['step'] = 1
+            manager._mark_dirty('1', session)
+
+            flush = asyncio.create_task(manager.flush())
+            await asyncio.to_thread(backend.started.wait, 5)
+            # Changes made while the batch is being written belong to the next flush
+            session.context['step'] = 2
+            backend.release.set()
+            await flush
+
+            self.assertIsInstance(backend.saved['1'], str)
+            self.assertEqual(json.loads(backend.saved['1'])['context'], {'step': 1})
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import heapq
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import List, Optional
+from config import TRACE_SAMPLE_RATE, TRACE_MAX_TRACES, TRACE_MAX_AGE
+
+class Trace:
+    """Timeline of one sampled turn: named spans as offsets from the turn's start"""
+    __slots__ = ('name', 'user_id', 'started_at', 'start', 'end', 'spans', 'error')
+
+    def __init__(self, name: str, user_id: Optional[str] = None):
+        self.name = name
+        self.user_id = user_id
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.spans: List[tuple] = []
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'user_id': self.user_id,
+            'started_at': self.started_at.isoformat(),
+            'duration': self.duration,
+            'error': self.error,
+            'spans': [
+                {'name': name, 'offset': start - self.start, 'duration': duration}
+                for name, start, duration in sorted(self.spans, key=lambda span: span[1])
+            ]
+        }
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+class span:
+    """
+    Time a block as a span of the current task's trace.
+    Costs one context variable lookup when the turn isn't sampled.
+    """
+    __slots__ = ('name', 'trace', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.spans.append((self.name, self.start, time.perf_counter() - self.start))
+        return False
+
+def add_span(name: str, start: float, duration: float):
+    """Add a span timed by the caller, for waits a ``with`` block can't wrap"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, start, duration))
+
+class Tracer:
+    """
+    Samples turns at ``sample_rate`` and keeps the ``max_traces`` slowest
+    sampled turns finished within the last ``max_age`` seconds.
+    """
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, max_traces: int = TRACE_MAX_TRACES,
+                 max_age: float = TRACE_MAX_AGE):
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.max_age = max_age
+        self._slowest: List[tuple] = []
+        self._sequence = itertools.count()
+        self.turns = 0
+        self.sampled = 0
+
+    @contextmanager
+    def trace(self, name: str, user_id: Optional[str] = None):
+        """Trace the block as one turn if it is sampled; yields the Trace or None"""
+        self.turns += 1
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            yield None
+            return
+
+        self.sampled += 1
+        trace = Trace(name, user_id)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.error = type(e).__name__
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.end = time.perf_counter()
+            self._keep(trace)
+
+    def _expire(self, now: float):
+        if self._slowest and any(now - entry[2].end > self.max_age for entry in self._slowest):
+            self._slowest = [entry for entry in self._slowest if now - entry[2].end <= self.max_age]
+            heapq.heapify(self._slowest)
+
+    def _keep(self, trace: Trace):
+        self._expire(trace.end)
+        entry = (trace.duration, next(self._sequence), trace)
+        if len(self._slowest) < self.max_traces:
+            heapq.heappush(self._slowest, entry)
+        elif entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def get_traces(self) -> dict:
+        """Slowest recent sampled turns, slowest first"""
+        self._expire(time.perf_counter())
+        return {
+            'sample_rate': self.sample_rate,
+            'turns': self.turns,
+            'sampled': self.sampled,
+            'traces': [entry[2].to_dict() for entry in sorted(self._slowest, reverse=True)]
+        }
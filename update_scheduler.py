@@ -0,0 +1,170 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from logger import logger
+from coalescer import MessageCoalescer
+from admission import AdmissionController, PRIORITY_CALLBACK, PRIORITY_MESSAGE, SHED_RATE_LIMITED
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor that runs different users' updates concurrently while
+    keeping each user's messages and button callbacks strictly in order.
+
+    ``max_pending`` bounds how many updates may be inside the processor at
+    once (PTB's own semaphore), ``max_workers`` bounds how many of those are
+    actually running a handler. Waiting for a user's turn happens before a
+    worker slot is taken, so one busy user can't occupy the whole pool.
+
+    With a ``coalescer``, a plain text message from a user whose only update
+    in flight is an open coalescing turn is folded into that turn instead of
+    being queued. Anything else queued for the user blocks this, so merged
+    text never overtakes a pending button press. The turn's collection
+    window is waited out here, before a worker slot is taken, so debouncing
+    doesn't hold workers idle.
+
+    Worker slots are handed out by an ``admission`` controller, which may
+    shed an update (over its user's rate, queue full, or waited too long)
+    instead of running it; ``on_shed(update, reason)`` then sends the user a
+    cheap reply. Without one, slots are a plain FIFO of ``max_workers``.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, coalescer: Optional[MessageCoalescer] = None,
+                 admission: Optional[AdmissionController] = None,
+                 on_shed: Optional[Callable[[Update, str], Awaitable[Any]]] = None):
+        super().__init__(max(max_pending, max_workers, 2))
+        if max_workers < 1:
+            raise ValueError("max_workers must be a positive integer")
+        self.admission = admission or AdmissionController(max_workers, max_queue=None, user_rate=0, max_wait=0)
+        self.max_workers = self.admission.max_in_flight
+        self.coalescer = coalescer
+        self.on_shed = on_shed
+        self._user_locks: Dict[str, asyncio.Lock] = {}
+        self._user_depth: Dict[str, int] = {}
+        self._pending = 0
+        self._active = 0
+        self._processed = 0
+
+    @staticmethod
+    def ordering_key(update: object) -> Optional[str]:
+        """Key under which updates must be processed in order"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return str(update.effective_user.id)
+            if update.effective_chat:
+                return f"chat:{update.effective_chat.id}"
+        return None
+
+    @staticmethod
+    def priority(update: object) -> int:
+        """Button presses are admitted ahead of messages"""
+        if isinstance(update, Update) and update.callback_query is not None:
+            return PRIORITY_CALLBACK
+        return PRIORITY_MESSAGE
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Wait for the user's previous updates, then run on a free worker"""
+        key = self.ordering_key(update)
+        priority = self.priority(update)
+        deadline = self.admission.deadline()
+        self._pending += 1
+        try:
+            if key is None:
+                await self._run(update, coroutine, key, priority, deadline)
+                return
+
+            if self._user_depth.get(key) == 1 and self._coalesce(update, key):
+                # The update's handlers will never run, its text is already buffered
+                coroutine.close()
+                return
+
+            if not self.admission.check_rate(key, priority):
+                await self._shed(update, coroutine, key, priority, SHED_RATE_LIMITED)
+                return
+
+            lock = self._user_locks.get(key)
+            if lock is None:
+                lock = self._user_locks[key] = asyncio.Lock()
+            self._user_depth[key] = self._user_depth.get(key, 0) + 1
+            try:
+                async with lock:
+                    if self._open_turn(update, key):
+                        try:
+                            await asyncio.sleep(self.coalescer.window)
+                            if deadline is not None:
+                                deadline += self.coalescer.window
+                            await self._run(update, coroutine, key, priority, deadline)
+                        finally:
+                            # Normally closed by the handler; not if the update was shed
+                            self.coalescer.close(key, update.effective_chat.id)
+                    else:
+                        await self._run(update, coroutine, key, priority, deadline)
+            finally:
+                depth = self._user_depth[key] - 1
+                if depth:
+                    self._user_depth[key] = depth
+                else:
+                    del self._user_depth[key]
+                    del self._user_locks[key]
+        finally:
+            self._pending -= 1
+
+    def _coalescable(self, update: object) -> bool:
+        if self.coalescer is None or not self.coalescer.enabled:
+            return False
+        message = update.message
+        return message is not None and bool(message.text) and not message.text.startswith('/')
+
+    def _coalesce(self, update: object, key: str) -> bool:
+        """Fold the message into the user's open turn, only if that turn is in the same chat"""
+        return (self._coalescable(update)
+                and self.coalescer.absorb(key, update.effective_chat.id, update.message.text))
+
+    def _open_turn(self, update: object, key: str) -> bool:
+        """Open the user's buffer for a text message about to run, so follow-ups join it"""
+        if not self._coalescable(update):
+            return False
+        self.coalescer.open(key, update.effective_chat.id, update.message.text)
+        return True
+
+    async def _run(self, update: object, coroutine: Awaitable[Any], key: Optional[str],
+                   priority: int, deadline: Optional[float]) -> None:
+        reason = await self.admission.acquire(priority, deadline)
+        if reason is not None:
+            await self._shed(update, coroutine, key, priority, reason)
+            return
+        self._active += 1
+        try:
+            await coroutine
+        finally:
+            self._active -= 1
+            self._processed += 1
+            self.admission.release()
+
+    async def _shed(self, update: object, coroutine: Awaitable[Any], key: Optional[str], priority: int, reason: str):
+        """Drop an update without running its handlers, telling the user when appropriate"""
+        coroutine.close()
+        # Callbacks are always answered so the button stops spinning; messages at most once per interval
+        if self.on_shed is None or not (priority == PRIORITY_CALLBACK or self.admission.should_notify(key)):
+            return
+        try:
+            await self.on_shed(update, reason)
+        except Exception as e:
+            logger.warning(f"Could not notify user of shed update: {str(e)}")
+
+    async def initialize(self) -> None:
+        logger.info(f"Update scheduler started with {self.max_workers} workers")
+
+    async def shutdown(self) -> None:
+        logger.info(f"Update scheduler stopped after {self._processed} updates")
+
+    def get_stats(self) -> dict:
+        """Queue depth and worker usage"""
+        return {
+            'workers': self.max_workers,
+            'active': self._active,
+            'queued': self._pending - self._active,
+            'users_queued': len(self._user_depth),
+            'max_user_depth': max(self._user_depth.values(), default=0),
+            'processed': self._processed
+        }
@@ -1,97 +1,377 @@
-import requests
-from typing import Dict, List, Optional
-from config import VOICEFLOW_API_KEY, VOICEFLOW_API_BASE_URL
+import asyncio
+import time
+import httpx
+from dataclasses import dataclass, field
+import json
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from config import (
+    VOICEFLOW_API_KEY,
+    VOICEFLOW_PROJECT_ID,
+    VOICEFLOW_API_BASE_URL,
+    VOICEFLOW_TIMEOUT,
+    VOICEFLOW_HTTP2,
+    VOICEFLOW_MAX_CONNECTIONS,
+    VOICEFLOW_MAX_KEEPALIVE_CONNECTIONS,
+    VOICEFLOW_KEEPALIVE_EXPIRY,
+    VOICEFLOW_MIN_TIMEOUT,
+    VOICEFLOW_TIMEOUT_MULTIPLIER,
+    VOICEFLOW_MAX_RETRIES,
+    VOICEFLOW_RETRY_BACKOFF,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_WINDOW,
+    BREAKER_FAILURE_RATIO,
+    BREAKER_COOLDOWN,
+)
 from logger import logger
+from metrics import STAGE_SECONDS, ERRORS
+from resilience import CircuitBreaker, AdaptiveTimeout, backoff_delay
+from tracing import span, add_span
+
+@dataclass(slots=True)
+class ParsedResponse:
+    """A Voiceflow trace list reduced to what the bot renders and records"""
+    text: Optional[str] = None
+    buttons: List[str] = field(default_factory=list)
+    image_url: Optional[str] = None
+    context: Dict = field(default_factory=dict)
+    carousel: Optional[List[Dict]] = None
+    card: Optional[Dict] = None
+
+class ResponseBuilder:
+    """
+    Incremental trace parser: traces are fed one at a time as they arrive,
+    and the text so far can be read at any point while streaming.
+    """
 
-class VoiceflowClient:
     def __init__(self):
-        self.api_key = VOICEFLOW_API_KEY
+        self.text_parts: List[str] = []
+        self.buttons: List[str] = []
+        self.image_url: Optional[str] = None
+        self.context: Dict = {}
+        self.carousel: Optional[List[Dict]] = None
+        self.card: Optional[Dict] = None
+
+    @property
+    def text(self) -> Optional[str]:
+        return '\n'.join(self.text_parts) if self.text_parts else None
+
+    def feed(self, trace: Dict) -> bool:
+        """Apply one trace, returning whether the text changed"""
+        trace_type = trace.get('type')
+        payload = trace.get('payload') or {}
+
+        if trace_type == 'speak' or trace_type == 'text':
+            self.text_parts.append(payload.get('message', ''))
+            return True
+
+        if trace_type == 'completion':
+            # Streamed LLM output: start opens a text part, content chunks extend it
+            state = payload.get('state')
+            if state == 'start':
+                self.text_parts.append('')
+            elif state == 'content' and payload.get('content'):
+                if not self.text_parts:
+                    self.text_parts.append('')
+                self.text_parts[-1] += payload['content']
+                return True
+
+        elif trace_type == 'choice':
+            self.buttons.extend(
+                button.get('name')
+                for button in payload.get('buttons', [])
+            )
+
+        elif trace_type == 'visual':
+            if 'image' in payload:
+                self.image_url = payload['image']
+
+        elif trace_type == 'carousel':
+            self.carousel = payload.get('items', [])
+
+        elif trace_type == 'card':
+            self.card = {
+                'title': payload.get('title'),
+                'description': payload.get('description'),
+                'image': payload.get('image'),
+                'buttons': [btn.get('name') for btn in payload.get('buttons', [])]
+            }
+
+        elif trace_type == 'context':
+            self.context.update(payload)
+
+        return False
+
+    def result(self) -> ParsedResponse:
+        return ParsedResponse(
+            text=self.text,
+            buttons=self.buttons,
+            image_url=self.image_url,
+            context=self.context,
+            carousel=self.carousel,
+            card=self.card
+        )
+
+async def iter_sse(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[str, str]]:
+    """Yield (event, data) pairs from a server-sent events line stream"""
+    event = 'message'
+    data: List[str] = []
+    async for line in lines:
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event = 'message'
+            data = []
+        elif line.startswith(':'):
+            continue  # Keep-alive comment
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+    if data:
+        yield event, '\n'.join(data)
+
+def create_http_client(base_url: str = VOICEFLOW_API_BASE_URL,
+                       headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+    """Pooled HTTP client for the Voiceflow runtime API"""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        limits=httpx.Limits(
+            max_connections=VOICEFLOW_MAX_CONNECTIONS,
+            max_keepalive_connections=VOICEFLOW_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=VOICEFLOW_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(VOICEFLOW_TIMEOUT),
+        http2=VOICEFLOW_HTTP2
+    )
+
+class VoiceflowClient:
+    def __init__(self, api_key: Optional[str] = VOICEFLOW_API_KEY, project_id: Optional[str] = VOICEFLOW_PROJECT_ID,
+                 http_client: Optional[httpx.AsyncClient] = None):
+        self.api_key = api_key
+        self.project_id = project_id
         self.base_url = VOICEFLOW_API_BASE_URL
         self.headers = {
             'Authorization': self.api_key,
             'Content-Type': 'application/json',
             'versionID': 'production'  # Always use production version
         }
+        # Pool default; each call passes the adaptive timeout below
+        self.default_timeout = httpx.Timeout(VOICEFLOW_TIMEOUT)
+        self.timeout = AdaptiveTimeout(VOICEFLOW_MIN_TIMEOUT, VOICEFLOW_TIMEOUT, VOICEFLOW_TIMEOUT_MULTIPLIER)
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_WINDOW, BREAKER_COOLDOWN,
+                                      BREAKER_FAILURE_RATIO)
+        self.max_retries = VOICEFLOW_MAX_RETRIES
+        self.retry_backoff = VOICEFLOW_RETRY_BACKOFF
+        # A client passed in is shared with other projects: requests carry their own
+        # credentials and closing this VoiceflowClient leaves it open
+        self._client: Optional[httpx.AsyncClient] = http_client
+        self._owns_client = http_client is None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Shared pooled HTTP client, created on first use so it binds to the running loop"""
+        if self._client is None or (self._owns_client and self._client.is_closed):
+            self._client = create_http_client(self.base_url, self.headers)
+        return self._client
+
+    async def close(self):
+        """Close the pooled HTTP client and its keep-alive connections, unless it is shared"""
+        if not self._owns_client:
+            return
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    @staticmethod
+    def _is_retryable(error: httpx.HTTPError, idempotent: bool) -> bool:
+        """Errors where retrying can't replay a dialog turn Voiceflow already ran"""
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True  # The request never reached Voiceflow
+        if not idempotent:
+            return False
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        return isinstance(error, (httpx.TimeoutException, httpx.TransportError))
 
-    def interact(self, user_id: str, request: Dict, context: Dict = None) -> List[Dict]:
+    def _record_outcome(self, ticket: Optional[int], error: Optional[BaseException]):
         """
-        Interact with the Voiceflow dialog manager
+        Feed the circuit breaker. Client errors (4xx) don't count against
+        Voiceflow, and neither does waiting too long for one of our own
+        pooled connections, which is local overload.
         """
+        if isinstance(error, httpx.PoolTimeout):
+            self.breaker.release_probe(ticket)
+        elif error is None or (isinstance(error, httpx.HTTPStatusError) and error.response.status_code < 500):
+            self.breaker.record_success(ticket)
+        else:
+            self.breaker.record_failure(ticket)
+
+    def _call_timeout(self, ticket: Optional[int]) -> float:
+        """The adaptive timeout, or the maximum for the breaker's probe so a slower Voiceflow can still pass it"""
+        return self.timeout.maximum if self.breaker.is_probe(ticket) else self.timeout.current()
+
+    def _observe_timeout(self, error: httpx.HTTPError, timeout: float):
+        """Widen the adaptive timeout after Voiceflow itself was too slow"""
+        if isinstance(error, httpx.TimeoutException) and not isinstance(error, httpx.PoolTimeout):
+            self.timeout.observe_timeout(timeout)
+
+    async def interact(self, user_id: str, request: Dict, context: Dict = None, idempotent: bool = False) -> List[Dict]:
+        """
+        Interact with the Voiceflow dialog manager.
+        Only requests that are safe to repeat should pass ``idempotent=True``.
+        """
+        ticket = self.breaker.allow()
+        if ticket is None:
+            ERRORS.inc(component='voiceflow', type='CircuitOpen')
+            logger.warning(f"Voiceflow circuit open, rejecting request for user {user_id}")
+            raise Exception("The assistant is temporarily unavailable. Please try again in a moment.")
+
         try:
-            endpoint = f"{self.base_url}/state/user/{user_id}/interact"
+            endpoint = f"/state/user/{user_id}/interact"
             
             # Include context in the request if provided
             if context:
                 request['context'] = context
 
-            response = requests.post(
-                endpoint,
-                headers=self.headers,
-                json=request,
-                timeout=10  # Add timeout for better error handling
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.Timeout:
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                timeout = self._call_timeout(ticket)
+                try:
+                    with STAGE_SECONDS.time(stage='voiceflow_interact'), span('voiceflow_interact'):
+                        response = await self.client.post(endpoint, json=request, headers=self.headers,
+                                                          timeout=timeout)
+                        response.raise_for_status()
+                        result = response.json()
+                except httpx.HTTPError as e:
+                    self._observe_timeout(e, timeout)
+                    if attempt < self.max_retries and self._is_retryable(e, idempotent):
+                        attempt += 1
+                        ERRORS.inc(component='voiceflow_retry', type=type(e).__name__)
+                        await asyncio.sleep(backoff_delay(attempt, self.retry_backoff))
+                        continue
+                    raise
+                self.timeout.observe(time.perf_counter() - start)
+                self._record_outcome(ticket, None)
+                return result
+        except asyncio.CancelledError:
+            self.breaker.release_probe(ticket)
+            raise
+        except httpx.TimeoutException as e:
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
             logger.error(f"Timeout while connecting to Voiceflow API for user {user_id}")
             raise Exception("Connection timeout. Please try again.")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
             logger.error(f"Voiceflow API error: {str(e)}")
             raise Exception("Failed to communicate with Voiceflow. Please try again.")
         except Exception as e:
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
             logger.error(f"Unexpected error in Voiceflow interaction: {str(e)}")
             raise
 
-    def process_response(self, response: List[Dict]) -> Dict:
+    async def interact_stream(self, user_id: str, request: Dict, context: Dict = None) -> AsyncIterator[Dict]:
         """
-        Process Voiceflow response and extract relevant information
+        Interact through Voiceflow's streaming endpoint, yielding traces as
+        server-sent events arrive. Never retried: the turn starts running as
+        soon as the request is accepted.
         """
+        ticket = self.breaker.allow()
+        if ticket is None:
+            ERRORS.inc(component='voiceflow', type='CircuitOpen')
+            logger.warning(f"Voiceflow circuit open, rejecting request for user {user_id}")
+            raise Exception("The assistant is temporarily unavailable. Please try again in a moment.")
+
+        endpoint = f"/v2/project/{self.project_id}/user/{user_id}/interact/stream"
+        body = {'action': request['request']}
+        if context:
+            body['variables'] = context
+
+        # Only time spent waiting on Voiceflow is timed, not the consumer's work between events
+        started = resumed = time.perf_counter()
+        waited = 0.0
+        first_event = True
         try:
-            result = {
-                'text': None,
-                'buttons': [],
-                'image_url': None,
-                'context': {},
-                'carousel': None,
-                'card': None
-            }
+            # Connecting uses the adaptive timeout; generation time between events may be long
+            connect_timeout = self._call_timeout(ticket)
+            timeout = httpx.Timeout(self.default_timeout.read, connect=connect_timeout)
+            async with self.client.stream(
+                'POST', endpoint, json=body, params={'completion_events': 'true'},
+                headers={**self.headers, 'Accept': 'text/event-stream'}, timeout=timeout
+            ) as response:
+                response.raise_for_status()
+                async for event, data in iter_sse(response.aiter_lines()):
+                    if event == 'end':
+                        break
+                    if event == 'trace':
+                        trace = json.loads(data)
+                        now = time.perf_counter()
+                        waited += now - resumed
+                        add_span('voiceflow_stream', resumed, now - resumed)
+                        if first_event:
+                            STAGE_SECONDS.observe(now - started, stage='voiceflow_stream_first_event')
+                            first_event = False
+                        resumed = None
+                        yield trace
+                        resumed = time.perf_counter()
+            self._record_outcome(ticket, None)
+        except (GeneratorExit, asyncio.CancelledError):
+            # The consumer stopped early or the turn was cancelled: no verdict on Voiceflow
+            self.breaker.release_probe(ticket)
+            raise
+        except httpx.TimeoutException as e:
+            if isinstance(e, httpx.ConnectTimeout):
+                self._observe_timeout(e, connect_timeout)
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
+            logger.error(f"Timeout while streaming from Voiceflow API for user {user_id}")
+            raise Exception("Connection timeout. Please try again.")
+        except httpx.HTTPError as e:
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
+            logger.error(f"Voiceflow API error: {str(e)}")
+            raise Exception("Failed to communicate with Voiceflow. Please try again.")
+        except Exception as e:
+            self._record_outcome(ticket, e)
+            ERRORS.inc(component='voiceflow', type=type(e).__name__)
+            logger.error(f"Unexpected error in Voiceflow stream: {str(e)}")
+            raise
+        finally:
+            if resumed is not None:
+                now = time.perf_counter()
+                waited += now - resumed
+                add_span('voiceflow_stream', resumed, now - resumed)
+            STAGE_SECONDS.observe(waited, stage='voiceflow_stream')
 
-            for trace in response:
-                trace_type = trace.get('type')
-                payload = trace.get('payload', {})
-                
-                if trace_type == 'speak' or trace_type == 'text':
-                    if result['text'] is None:
-                        result['text'] = payload.get('message', '')
-                    else:
-                        result['text'] += f"\n{payload.get('message', '')}"
-                
-                elif trace_type == 'choice':
-                    result['buttons'].extend([
-                        button.get('name')
-                        for button in payload.get('buttons', [])
-                    ])
-                
-                elif trace_type == 'visual':
-                    if 'image' in payload:
-                        result['image_url'] = payload['image']
-                
-                elif trace_type == 'carousel':
-                    result['carousel'] = payload.get('items', [])
-                
-                elif trace_type == 'card':
-                    result['card'] = {
-                        'title': payload.get('title'),
-                        'description': payload.get('description'),
-                        'image': payload.get('image'),
-                        'buttons': [btn.get('name') for btn in payload.get('buttons', [])]
-                    }
-                
-                elif trace_type == 'context':
-                    result['context'].update(payload)
-
-            return result
+    def get_stats(self) -> dict:
+        """Circuit breaker state and the timeout currently applied"""
+        return {
+            'circuit': self.breaker.get_stats(),
+            'timeout': self.timeout.current()
+        }
 
+    def process_response(self, response: List[Dict]) -> ParsedResponse:
+        """
+        Process Voiceflow response and extract relevant information in a single pass
+        """
+        try:
+            with STAGE_SECONDS.time(stage='parse_response'), span('parse_response'):
+                return self._parse(response)
         except Exception as e:
+            ERRORS.inc(component='parser', type=type(e).__name__)
             logger.error(f"Error processing Voiceflow response: {str(e)}")
             raise Exception("Error processing bot response. Please try again.")
+
+    def _parse(self, response: List[Dict]) -> ParsedResponse:
+        """Single pass over the trace list"""
+        builder = ResponseBuilder()
+        for trace in response:
+            builder.feed(trace)
+        return builder.result()
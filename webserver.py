@@ -0,0 +1,145 @@
+import hmac
+import json
+from typing import Callable, List, Optional
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+from logger import logger
+from profiler import SamplingProfiler, format_folded
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+DEBUG_TOKEN_HEADER = 'X-Debug-Token'
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Accepts Telegram updates and hands them to the bot's update queue"""
+
+    def initialize(self, bot_application: Application, secret_token: Optional[str] = None):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            logger.warning("Rejected webhook request with invalid secret token")
+            raise tornado.web.HTTPError(403)
+
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.bot_application.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {str(e)}")
+            raise tornado.web.HTTPError(400)
+
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+class JSONHandler(tornado.web.RequestHandler):
+    """Serves the dict returned by a provider callable as JSON"""
+
+    def initialize(self, provider: Callable[[], dict]):
+        self.provider = provider
+
+    def get(self):
+        self.write(self.provider())
+
+class TextHandler(tornado.web.RequestHandler):
+    """Serves the string returned by a provider callable"""
+
+    def initialize(self, provider: Callable[[], str], content_type: str = 'text/plain; charset=utf-8'):
+        self.provider = provider
+        self.content_type = content_type
+
+    def get(self):
+        self.set_header('Content-Type', self.content_type)
+        self.write(self.provider())
+
+class DebugTokenMixin:
+    """Rejects requests that don't carry the debug token header"""
+
+    def check_debug_token(self):
+        supplied = self.request.headers.get(DEBUG_TOKEN_HEADER, '')
+        if not hmac.compare_digest(supplied.encode(), self.debug_token.encode()):
+            raise tornado.web.HTTPError(403)
+
+class DebugJSONHandler(DebugTokenMixin, JSONHandler):
+    """JSONHandler restricted to holders of the debug token"""
+
+    def initialize(self, provider: Callable[[], dict], debug_token: str):
+        super().initialize(provider)
+        self.debug_token = debug_token
+
+    def prepare(self):
+        self.check_debug_token()
+
+class ProfileHandler(DebugTokenMixin, tornado.web.RequestHandler):
+    """Runs the sampling profiler for ?seconds=N and returns aggregated stacks"""
+
+    def initialize(self, profiler: SamplingProfiler, debug_token: str, max_seconds: float):
+        self.profiler = profiler
+        self.debug_token = debug_token
+        self.max_seconds = max_seconds
+
+    def prepare(self):
+        self.check_debug_token()
+
+    async def get(self):
+        try:
+            seconds = float(self.get_argument('seconds', '5'))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not 0 < seconds <= self.max_seconds:
+            raise tornado.web.HTTPError(400, reason=f"seconds must be in (0, {self.max_seconds:g}]")
+        if self.profiler.running:
+            raise tornado.web.HTTPError(409, reason="A profile is already running")
+
+        result = await self.profiler.profile(seconds)
+        if self.get_argument('format', 'json') == 'folded':
+            self.set_header('Content-Type', 'text/plain; charset=utf-8')
+            self.write(format_folded(result))
+        else:
+            self.write(result)
+
+class WebServer:
+    """Single asyncio HTTP server for the webhook, health checks and ops endpoints"""
+
+    def __init__(self, port: int, host: str = '0.0.0.0'):
+        self.port = port
+        self.host = host
+        self.routes: List[tuple] = []
+        self._server: Optional[HTTPServer] = None
+
+    def add_route(self, path: str, handler: type, **kwargs):
+        """Register a tornado RequestHandler for a path"""
+        self.routes.append((path, handler, kwargs))
+
+    def add_json_route(self, path: str, provider: Callable[[], dict]):
+        """Register a GET endpoint returning the provider's dict as JSON"""
+        self.add_route(path, JSONHandler, provider=provider)
+
+    def add_text_route(self, path: str, provider: Callable[[], str], content_type: str = 'text/plain; charset=utf-8'):
+        """Register a GET endpoint returning the provider's string"""
+        self.add_route(path, TextHandler, provider=provider, content_type=content_type)
+
+    def add_webhook(self, path: str, bot_application: Application, secret_token: Optional[str] = None):
+        """Register the Telegram webhook endpoint"""
+        self.add_route(path, TelegramWebhookHandler, bot_application=bot_application, secret_token=secret_token)
+
+    def add_debug_routes(self, debug_token: str, traces: Callable[[], dict], profiler: SamplingProfiler,
+                         max_seconds: float):
+        """Register /debug/traces and /debug/profile, both requiring the debug token header"""
+        self.add_route('/debug/traces', DebugJSONHandler, provider=traces, debug_token=debug_token)
+        self.add_route('/debug/profile', ProfileHandler, profiler=profiler, debug_token=debug_token,
+                       max_seconds=max_seconds)
+
+    async def start(self):
+        app = tornado.web.Application(self.routes)
+        self._server = HTTPServer(app, xheaders=True)
+        self._server.listen(self.port, self.host)
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+            logger.info("Web server stopped")